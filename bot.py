@@ -4,15 +4,25 @@ Telegram бот для выдачи VPN конфигураций из x-ui
 import logging
 import asyncio
 import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, Chat, User, ReplyKeyboardMarkup, KeyboardButton
+from telegram.constants import ChatAction
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    AIORateLimiter,
     ContextTypes,
+    Defaults,
     filters
 )
 from xui_client import XUIClient
@@ -42,6 +52,17 @@ try:
 except ImportError:
     CONFIG_EXPIRY_DAYS = 31  # Дефолтное значение: 31 день
 
+try:
+    from config import INSTRUCTION_VIDEO_FILE_ID
+except ImportError:
+    INSTRUCTION_VIDEO_FILE_ID = None  # Видео инструкции по file_id не настроено
+
+# Срок действия нового или продленного конфига
+CONFIG_EXPIRY_DELTA = timedelta(days=CONFIG_EXPIRY_DAYS)
+
+# Email конфига с номером в конце (например, username_1)
+EMAIL_WITH_NUMBER_RE = re.compile(r'^(.+)_(\d+)$')
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -53,21 +74,111 @@ logger = logging.getLogger(__name__)
 xui_client = XUIClient()
 db = Database()
 
+# Нормализованные списки username (без @, в нижнем регистре) вычисляем один раз при импорте
+ADMIN_USERNAMES_SET = frozenset(u.lstrip('@').lower() for u in ADMIN_USERNAMES)
+ALLOWED_USERNAMES_SET = frozenset(u.lstrip('@').lower() for u in ALLOWED_USERNAMES)
+# Пустой ALLOWED_USERNAMES означает, что доступ выдается через /allowed (таблица allowed_users)
+ACCESS_FROM_DB = not ALLOWED_USERNAMES_SET
+
+# Клавиатуры меню не меняются, поэтому собираем их один раз при загрузке модуля
+# 1 строка: Создать конфиг и Скачать конфиг
+# 2 строка: Информация и Продлить
+# 3 строка: Инструкция и Связь с администратором
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✨ Создать конфиг", callback_data="create_config"),
+        InlineKeyboardButton("📥 Скачать конфиг", callback_data="download_config")
+    ],
+    [
+        InlineKeyboardButton("📊 Информация", callback_data="config_info"),
+        InlineKeyboardButton("🤘 Продлить", callback_data="config_extend"),
+    ],
+    [
+        InlineKeyboardButton("📹 Инструкция", callback_data="instruction"),
+        InlineKeyboardButton("💬 Связь с администратором", callback_data="contact_admin")
+    ]
+])
+
+# Reply кнопка "Меню"
+MENU_REPLY_MARKUP = ReplyKeyboardMarkup([[KeyboardButton("Меню")]], resize_keyboard=True)
+
+MENU_TEXT = """
+🤖 Привет! Я бот для получения VPN конфигураций.
+
+📋 Доступные команды:
+• Создание конфига
+• Скачивание конфига
+• Информация о конфиге
+• Связь с администратором
+
+💡 Используйте кнопки 👇 для работы с ботом.
+"""
+
+# Шаблоны сообщений: постоянная часть собирается один раз, при вызове подставляются только поля
+CONFIG_INFO_TEMPLATE = (
+    "━━━━━━━━━━\n"
+    "📧 Конфиг #{number}: {email}\n"
+    "📈 Трафик: {total} (↑{up} ↓{down})\n"
+    "⏰ Осталось дней: {days_remaining}\n"
+    "📅 До: {expire}\n"
+    "⏰ Последний вход: {last_online}\n\n"
+)
+
+CONTACT_ADMIN_TEMPLATE = """
+💬 Связь с администратором:
+
+👤 Администратор:
+• {admin_list}
+
+📝 Для связи с администратором:
+1. Напишите администратору в Telegram
+2. Укажите ваш username: @{{username}}
+3. Опишите вашу проблему или вопрос
+
+💡 Администратор может помочь с:
+• Увеличением лимита конфигов
+• Решением технических проблем
+• Вопросами по использованию бота
+""".format(admin_list=', '.join('@' + u.lstrip('@').lower() for u in ADMIN_USERNAMES))
+# При нажатии подставляется только username: склеиваем заранее разрезанный шаблон без format
+CONTACT_ADMIN_PREFIX, _, CONTACT_ADMIN_SUFFIX = CONTACT_ADMIN_TEMPLATE.partition("{username}")
+
+
 def is_admin(username: Optional[str]) -> bool:
     """Проверка, является ли пользователь администратором по username"""
     if not username:
         return False
-    # Нормализуем username (убираем @ если есть)
-    username_normalized = username.lstrip('@').lower()
-    
     # Проверяем в списке администраторов из config
-    admin_list = [u.lstrip('@').lower() for u in ADMIN_USERNAMES]
-    if username_normalized in admin_list:
-        return True
+    return username.lstrip('@').lower() in ADMIN_USERNAMES_SET
+
+# Результаты проверки доступа через базу: username -> (есть доступ, время проверки).
+# Сбрасываются командами, которые меняют список доступа (/allowed, /deleteuser, /cleardb)
+ACCESS_CACHE_TTL = 60  # секунды
+access_cache: Dict[str, Tuple[bool, float]] = {}
+# Растет при каждом сбросе: проверка, начатая до изменения доступа, не попадет в кеш
+access_cache_epoch = 0
+access_cache_lock = threading.Lock()
+
+
+def get_cached_access_db(username_normalized: str) -> Optional[bool]:
+    """Результат проверки доступа из кеша или None, если его нет или он устарел"""
+    cached = access_cache.get(username_normalized)
+    if cached and time.monotonic() - cached[1] < ACCESS_CACHE_TTL:
+        return cached[0]
+    return None
+
+
+def invalidate_access_cache():
+    """Сбросить кеш доступа целиком
     
-    # Также проверяем в базе данных (для обратной совместимости)
-    # Но это не используется, так как проверка идет только по username из config
-    return False
+    В базе username сравнивается с учетом регистра, поэтому точечно найти
+    запись в кеше по username из команды админа нельзя.
+    """
+    global access_cache_epoch
+    with access_cache_lock:
+        access_cache.clear()
+        access_cache_epoch += 1
+
 
 def check_access_db(username: Optional[str]) -> bool:
     """Проверка доступа пользователя по username"""
@@ -75,52 +186,271 @@ def check_access_db(username: Optional[str]) -> bool:
         return False  # Нет username - нет доступа
     # Нормализуем username (убираем @ если есть)
     username_normalized = username.lstrip('@')
-    return db.get_allowed_user(username_normalized)
+    allowed = get_cached_access_db(username_normalized)
+    if allowed is not None:
+        return allowed
+    
+    epoch = access_cache_epoch
+    allowed = db.get_allowed_user(username_normalized)
+    with access_cache_lock:
+        if epoch == access_cache_epoch:
+            access_cache[username_normalized] = (allowed, time.monotonic())
+    return allowed
 
 def check_access(username: Optional[str]) -> bool:
     """Проверка доступа пользователя по username"""
+    if not username:
+        return False  # Нет username - нет доступа
 
-    if is_admin(username):
+    normalized = username.lstrip('@').lower()
+    if normalized in ADMIN_USERNAMES_SET:
         return True
-
-    if not ALLOWED_USERNAMES:
+    if ACCESS_FROM_DB:
         return check_access_db(username)
-    if not username:
-        return False  # Нет username - нет доступа
+    return normalized in ALLOWED_USERNAMES_SET
+
+ACCESS_DENIED_TEXT = "❌ У вас нет доступа к этому боту."
+NO_USERNAME_HINT = "💡 Убедитесь, что у вас установлен username в настройках Telegram."
+
+# Тексты /start и справки не меняются между вызовами
+NO_USERNAME_WELCOME_TEXT = """
+❌ Для работы с ботом необходимо установить username в настройках Telegram.
+
+📝 Подробная инструкция по добавлению username:
+
+1️⃣ Откройте настройки Telegram:
+   • Нажмите на иконку меню (три полоски) в левом верхнем углу
+   • Или нажмите на ваше имя/аватар вверху экрана
+
+2️⃣ Найдите раздел "Имя пользователя" (Username):
+   • В настройках прокрутите вниз до раздела "Имя пользователя"
+   • Или используйте поиск в настройках
+
+3️⃣ Установите username:
+   • Нажмите на "Имя пользователя"
+   • Введите желаемый username (например: @myusername)
+   • Нажмите "Сохранить" или галочку ✓
+
+4️⃣ Вернитесь в бота:
+   • Вернитесь в чат с ботом
+   • Отправьте команду /start
+
+💡 Username нужен для создания и получения конфигураций.
+💡 Username должен быть уникальным и может содержать только буквы, цифры и подчеркивания.
+"""
+
+WELCOME_TEMPLATE = """
+🤖 Привет! Я бот для получения VPN конфигураций.
+
+📋 Что нужно сделать, чтобы начать:
+✅ У вас установлен username: @{username}
+
+📋 Доступные команды:
+• ✨ Создать конфиг - создать новый конфиг на 31 день
+• 📥 Скачать конфиг - получить ваш конфиг
+• 📊 Информация - объем данных и срок действия
+• 📹 Инструкция - видео инструкция по использованию
+• 💬 Связь с администратором - связаться с админом
+
+💡 Используйте кнопки 👇 или команду /start для открытия меню.
+"""
+
+HELP_TEXT = """
+📖 Справка по использованию бота:
+
+/create - Создать конфиг клиента
+💡 По умолчанию каждый пользователь может создать 1 клиента
+
+/myinfo - Показать информацию о вашем аккаунте
+
+💡 Конфигурация будет отправлена в виде ссылки, которую можно импортировать в VPN клиент.
+"""
+
+ADMIN_HELP_TEXT = """
+🔧 Админские команды:
+
+/allowed <username> - Открыть доступ пользователя в боту
+Пример: /allowed @username
+
+/adduser <username> <limit> - Добавить пользователя по username и установить лимит
+Пример: /adduser @username 5
+
+/setlimit <username> <limit> - Изменить лимит конфигов для пользователя
+Пример: /setlimit @username 10
+
+/extend <username> [days] - Продлить срок действия конфига на указанное количество дней
+Пример: /extend @username 31
+💡 Если days не указан, по умолчанию продлевается на 31 день
+
+/deleteuser <username> - Удалить все данные пользователя из базы данных
+Пример: /deleteuser @username
+⚠️ ВНИМАНИЕ: Удаляет все данные пользователя (конфиги, напоминания, пользователя)
+
+/users - Показать список всех пользователей
+
+/sync_reminders - Синхронизировать напоминания из x-ui
+
+/cleardb - Очистить всю базу данных (удалить все данные)
+
+💡 Username можно указывать с @ или без него.
+"""
+
+
+def require_access(func):
+    """Декоратор обработчика: пропускает только пользователей с доступом к боту"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        username = update.effective_user.username if update.effective_user else None
+        # Админы, статический список и свежий результат из кеша проверяются в памяти.
+        # В отдельный поток уходит только запрос к базе при промахе кеша
+        if not ACCESS_FROM_DB or not username or username.lstrip('@').lower() in ADMIN_USERNAMES_SET:
+            allowed = check_access(username)
+        else:
+            allowed = get_cached_access_db(username.lstrip('@'))
+            if allowed is None:
+                allowed = await asyncio.to_thread(check_access_db, username)
+        if not allowed:
+            text = ACCESS_DENIED_TEXT if username else f"{ACCESS_DENIED_TEXT}\n{NO_USERNAME_HINT}"
+            if update.callback_query:
+                await update.callback_query.answer(text, show_alert=True)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text)
+            return
+        return await func(update, context, *args, **kwargs)
+    return wrapper
+
+
+def require_admin(func):
+    """Декоратор обработчика: пропускает только администраторов, остальным не отвечает"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        username = update.effective_user.username if update.effective_user else None
+        if not is_admin(username):
+            return
+        return await func(update, context, *args, **kwargs)
+    return wrapper
+
+
+# Разделители записей в списках inbounds, клиентов и пользователей
+SEPARATOR = "─" * 20 + "\n\n"
+USERS_SEPARATOR = "─" * 30 + "\n\n"
+
+# Единицы объема трафика в байтах
+GIB = 1 << 30
+MIB = 1 << 20
 
-    # Нормализуем username (убираем @ если есть)
-    username_normalized = username.lstrip('@').lower()
-    return username_normalized in [u.lstrip('@').lower() for u in ALLOWED_USERNAMES]
 
 def trafficFormat( vol: int ):
-    in_gb = vol / (1024**3)
+    in_gb = vol / GIB
 
     if in_gb >= 1:
         return f"{in_gb:.2f} GB"
 
-    in_mb = vol / (1024**2)
+    in_mb = vol / MIB
 
     return f"{in_mb:.2f} MB"
 
-async def save_bot_message_id(context: ContextTypes.DEFAULT_TYPE, user_id: int, message_id: int):
+
+# Миллисекунд в сутках - сроки действия в x-ui хранятся в миллисекундах
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+@lru_cache(maxsize=4096)
+def format_timestamp(ms: int) -> str:
+    """Отформатировать время x-ui (в миллисекундах) как "ГГГГ-ММ-ДД ЧЧ:ММ"
+
+    Строка зависит только от значения, поэтому кешируется: сроки действия
+    одних и тех же конфигов форматируются при каждом выводе списка.
+    """
+    return datetime.fromtimestamp(ms / 1000).strftime("%Y-%m-%d %H:%M")
+
+
+def days_until(ms: int) -> int:
+    """Сколько полных дней осталось до момента ms (отрицательное число, если он уже прошел)"""
+    return (ms - int(time.time() * 1000)) // DAY_MS
+
+
+# Сколько последних сообщений бота на пользователя помнить для удаления при /start
+BOT_MESSAGES_LIMIT = 50
+# Ключ в user_data для последних message_id бота
+BOT_MESSAGES_KEY = "bot_messages"
+# Ключ в bot_data для file_id видео инструкции, загруженного в Telegram
+INSTRUCTION_VIDEO_KEY = "instruction_video_file_id"
+
+
+async def save_bot_message_id(context: ContextTypes.DEFAULT_TYPE, message_id: int):
     """Сохранить message_id сообщения бота для возможного удаления"""
     try:
-        if not hasattr(context, 'bot_data'):
-            context.bot_data = {}
-        bot_messages_key = f"bot_messages_{user_id}"
-        if bot_messages_key not in context.bot_data:
-            context.bot_data[bot_messages_key] = []
-        context.bot_data[bot_messages_key].append(message_id)
-        # Ограничиваем список последними 50 сообщениями, чтобы не накапливать слишком много
-        if len(context.bot_data[bot_messages_key]) > 50:
-            context.bot_data[bot_messages_key] = context.bot_data[bot_messages_key][-50:]
+        # Хранятся в данных текущего пользователя (context.user_data)
+        bot_messages = context.user_data.get(BOT_MESSAGES_KEY)
+        if bot_messages is None:
+            # Храним только последние BOT_MESSAGES_LIMIT сообщений, старые вытесняются автоматически
+            bot_messages = context.user_data[BOT_MESSAGES_KEY] = deque(maxlen=BOT_MESSAGES_LIMIT)
+        bot_messages.append(message_id)
     except Exception as e:
         logger.debug(f"Не удалось сохранить message_id сообщения: {e}")
 
 
-async def send_app_links(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int = None):
-    """Отправить ссылки на приложения для iOS и Android"""
-    app_links_text = """
+# Базовая задержка между попытками создать клиента: 0.2, 0.4, ... секунды (со случайным разбросом)
+CREATE_RETRY_BASE_DELAY = 0.2
+
+# Если ответ готов быстрее, сообщение "⏳ ..." не показываем
+SPINNER_DELAY = 0.2  # секунды
+
+
+async def run_with_spinner(query, spinner_text: str, awaitable):
+    """Дождаться результата, показав spinner_text, только если ожидание затянулось"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        # shield: по таймауту запрос к x-ui не отменяется, а продолжает выполняться
+        return await asyncio.wait_for(asyncio.shield(task), SPINNER_DELAY)
+    except asyncio.TimeoutError:
+        # Ошибка показа "⏳ ..." не должна оставить задачу без ожидания
+        try:
+            await query.edit_message_text(spinner_text)
+        except Exception as e:
+            logger.warning(f"Не удалось показать сообщение ожидания: {e}")
+        return await task
+
+
+# Запросы, которые сейчас выполняются: ключ -> задача
+inflight_requests: Dict[tuple, asyncio.Future] = {}
+
+
+async def run_single_flight(key: tuple, factory):
+    """Выполнить factory() один раз для всех одновременных вызовов с тем же ключом
+    
+    Повторный вызов, пока первый не завершился, не запускает работу заново,
+    а ждет и получает тот же результат (или то же исключение).
+    """
+    future = inflight_requests.get(key)
+    if future is None:
+        future = asyncio.ensure_future(factory())
+        inflight_requests[key] = future
+        future.add_done_callback(lambda _: inflight_requests.pop(key, None))
+    # shield: отмена одного из ожидающих не отменяет общую задачу
+    return await asyncio.shield(future)
+
+
+async def _send_messages(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, texts: List[str]):
+    """Отправить сообщения по порядку и сохранить их message_id"""
+    for text in texts:
+        try:
+            msg = await context.bot.send_message(chat_id=chat_id, text=text)
+            # Сохраняем message_id для возможного удаления
+            await save_bot_message_id(context, msg.message_id)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+
+
+def send_messages_in_background(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int,
+                                texts: List[str]):
+    """Отправить сообщения фоновой задачей, не задерживая обработчик"""
+    context.application.create_task(_send_messages(context, chat_id, user_id, texts))
+
+
+# Ссылки на приложения: текст и кнопки собираются один раз при загрузке модуля
+APP_LINKS_TEXT = """
 📱 Приложения для подключения:
 
 🍎 iOS (App Store):
@@ -133,194 +463,103 @@ async def send_app_links(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_
 
 💡 Рекомендуется использовать v2RayTun для Android и v2rayNG для iOS.
 """
-    
+
+APP_LINKS_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🍎 v2rayNG", url="https://apps.apple.com/app/v2rayng/id6446814690"),
+        InlineKeyboardButton("🍎 Shadowrocket", url="https://apps.apple.com/app/shadowrocket/id932747118")
+    ],
+    [
+        InlineKeyboardButton("🤖 v2RayTun", url="https://play.google.com/store/apps/details?id=com.v2raytun.android"),
+        InlineKeyboardButton("🤖 v2rayNG", url="https://github.com/2dust/v2rayNG/releases")
+    ]
+])
+
+
+async def send_app_links(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int = None):
+    """Отправить ссылки на приложения для iOS и Android одним сообщением"""
     try:
         msg = await context.bot.send_message(
             chat_id=chat_id,
-            text=app_links_text,
-            parse_mode='HTML',
-            disable_web_page_preview=False
+            text=APP_LINKS_TEXT,
+            reply_markup=APP_LINKS_MARKUP,
+            disable_web_page_preview=True
         )
         # Сохраняем message_id для возможного удаления
         if user_id:
-            await save_bot_message_id(context, user_id, msg.message_id)
+            await save_bot_message_id(context, msg.message_id)
     except Exception as e:
         logger.error(f"Ошибка при отправке ссылок на приложения: {e}")
 
 
+@require_access
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
     username = update.effective_user.username
     full_name = update.effective_user.full_name
-
-    if not check_access(username):
-        await update.message.reply_text(
-            "❌ У вас нет доступа к этому боту.\n"
-            "💡 Убедитесь, что у вас установлен username в настройках Telegram."
-        )
-        return
     
     # Регистрируем пользователя в базе при первом запуске
-    user = db.get_user(user_id)
-    if not user:
-        db.add_user(user_id, username, full_name, 1)  # Лимит по умолчанию: 1
-        user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_or_create_user, user_id, username, full_name, 1)  # Лимит по умолчанию: 1
     
     # Проверяем наличие username
     if not username:
-        welcome_text = """
-❌ Для работы с ботом необходимо установить username в настройках Telegram.
-
-📝 Подробная инструкция по добавлению username:
-
-1️⃣ Откройте настройки Telegram:
-   • Нажмите на иконку меню (три полоски) в левом верхнем углу
-   • Или нажмите на ваше имя/аватар вверху экрана
-
-2️⃣ Найдите раздел "Имя пользователя" (Username):
-   • В настройках прокрутите вниз до раздела "Имя пользователя"
-   • Или используйте поиск в настройках
-
-3️⃣ Установите username:
-   • Нажмите на "Имя пользователя"
-   • Введите желаемый username (например: @myusername)
-   • Нажмите "Сохранить" или галочку ✓
-
-4️⃣ Вернитесь в бота:
-   • Вернитесь в чат с ботом
-   • Отправьте команду /start
-
-💡 Username нужен для создания и получения конфигураций.
-💡 Username должен быть уникальным и может содержать только буквы, цифры и подчеркивания.
-"""
-        # Добавляем Reply кнопку "Меню"
-        reply_keyboard = [
-            [KeyboardButton("Меню")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+        await update.message.reply_text(NO_USERNAME_WELCOME_TEXT, reply_markup=MENU_REPLY_MARKUP)
         return
     
-    welcome_text = """
-🤖 Привет! Я бот для получения VPN конфигураций.
-
-📋 Что нужно сделать, чтобы начать:
-✅ У вас установлен username: @{username}
-
-📋 Доступные команды:
-• ✨ Создать конфиг - создать новый конфиг на 31 день
-• 📥 Скачать конфиг - получить ваш конфиг
-• 📊 Информация - объем данных и срок действия
-• 📹 Инструкция - видео инструкция по использованию
-• 💬 Связь с администратором - связаться с админом
-
-💡 Используйте кнопки 👇 или команду /start для открытия меню.
-""".format(username=username)
-    
-    # Добавляем Inline кнопки для быстрого доступа
-    # 1 строка: Создать конфиг и Скачать конфиг
-    # 2 строка: Информация и Инструкция
-    # 3 строка: Связь с администратором
-    inline_keyboard = [
-        [
-            InlineKeyboardButton("✨ Создать конфиг", callback_data="create_config"),
-            InlineKeyboardButton("📥 Скачать конфиг", callback_data="download_config")
-        ],
-        [
-            InlineKeyboardButton("📊 Информация", callback_data="config_info"),
-            InlineKeyboardButton("🤘 Продлить", callback_data="config_extend"),
-        ],
-        [   
-            InlineKeyboardButton("📹 Инструкция", callback_data="instruction"),
-            InlineKeyboardButton("💬 Связь с администратором", callback_data="contact_admin")
-        ]
-    ]
-    inline_markup = InlineKeyboardMarkup(inline_keyboard)
+    welcome_text = WELCOME_TEMPLATE.format(username=username)
     
-    # Добавляем Reply кнопку "Меню"
-    reply_keyboard = [
-        [KeyboardButton("Меню")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+    chat_id = update.message.chat_id
     
-    # Удаляем само сообщение с командой /start сразу
-    try:
-        await update.message.delete()
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение с командой /start: {e}")
+    # Забираем сохраненные id сообщений бота и сразу очищаем хранилище: пока идет удаление,
+    # параллельные обработчики могут добавлять новые сообщения
+    bot_messages = context.user_data.get(BOT_MESSAGES_KEY)
+    message_ids = list(bot_messages) if bot_messages else []
+    if bot_messages:
+        bot_messages.clear()
     
-    # Пытаемся удалить все предыдущие сообщения бота
-    try:
-        if hasattr(context, 'bot_data') and context.bot_data:
-            # Получаем список всех сохраненных message_id сообщений бота для этого пользователя
-            bot_messages_key = f"bot_messages_{user_id}"
-            bot_messages = context.bot_data.get(bot_messages_key, [])
-            
-            # Удаляем все сохраненные сообщения бота
-            for msg_id in bot_messages:
-                try:
-                    await context.bot.delete_message(
-                        chat_id=update.message.chat_id,
-                        message_id=msg_id
-                    )
-                except Exception as e:
-                    logger.debug(f"Не удалось удалить сообщение {msg_id}: {e}")
-            
-            # Очищаем список сообщений
-            context.bot_data[bot_messages_key] = []
-    except Exception as e:
-        logger.debug(f"Ошибка при попытке удалить предыдущие сообщения: {e}")
-    
-    # Отправляем новое сообщение с меню
-    menu_msg = await context.bot.send_message(
-        chat_id=update.message.chat_id,
-        text=welcome_text,
-        reply_markup=inline_markup
-        #reply_markup=reply_markup
+    # Удаление команды /start, удаление предыдущих сообщений бота и отправка нового меню
+    # не зависят друг от друга, поэтому выполняются одновременно
+    *delete_results, menu_msg = await asyncio.gather(
+        update.message.delete(),
+        *(context.bot.delete_message(chat_id=chat_id, message_id=msg_id) for msg_id in message_ids),
+        context.bot.send_message(
+            chat_id=chat_id,
+            text=welcome_text,
+            reply_markup=MAIN_MENU_MARKUP
+            #reply_markup=MENU_REPLY_MARKUP
+        ),
+        #context.bot.send_message(
+        #    chat_id=chat_id,
+        #    text="💡 Используйте кнопки 👇 для работы с ботом.",
+        #    reply_markup=inline_markup
+        #),
+        return_exceptions=True
     )
-    #inline_msg = await context.bot.send_message(
-    #    chat_id=update.message.chat_id,
-    #    text="💡 Используйте кнопки 👇 для работы с ботом.",
-    #    reply_markup=inline_markup
-    #)
+    
+    for msg_id, result in zip([update.message.message_id, *message_ids], delete_results):
+        if isinstance(result, Exception):
+            logger.debug(f"Не удалось удалить сообщение {msg_id}: {result}")
+    if isinstance(menu_msg, Exception):
+        raise menu_msg
     
     # Сохраняем message_id новых сообщений для возможного удаления
-    await save_bot_message_id(context, user_id, menu_msg.message_id)
-    # await save_bot_message_id(context, user_id, inline_msg.message_id)
+    await save_bot_message_id(context, menu_msg.message_id)
+    # await save_bot_message_id(context, inline_msg.message_id)
 
 
+@require_access
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
-    username = update.effective_user.username
-    
-    if not check_access(username):
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
-        return
-    
-    help_text = """
-📖 Справка по использованию бота:
-
-/create - Создать конфиг клиента
-💡 По умолчанию каждый пользователь может создать 1 клиента
-
-/myinfo - Показать информацию о вашем аккаунте
-
-💡 Конфигурация будет отправлена в виде ссылки, которую можно импортировать в VPN клиент.
-"""
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(HELP_TEXT)
 
 
+@require_access
 async def myinfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать информацию о пользователе"""
     user_id = update.effective_user.id
-    username = update.effective_user.username
-    
-    if not check_access(username):
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
-        return
     
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     if not user:
         await update.message.reply_text("❌ Пользователь не найден в базе.")
         return
@@ -348,53 +587,15 @@ async def myinfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ========== АДМИНСКИЕ КОМАНДЫ ==========
 
+@require_admin
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Справка по админским командам"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
-    help_text = """
-🔧 Админские команды:
-
-/allowed <username> - Открыть доступ пользователя в боту
-Пример: /allowed @username
-
-/adduser <username> <limit> - Добавить пользователя по username и установить лимит
-Пример: /adduser @username 5
-
-/setlimit <username> <limit> - Изменить лимит конфигов для пользователя
-Пример: /setlimit @username 10
-
-/extend <username> [days] - Продлить срок действия конфига на указанное количество дней
-Пример: /extend @username 31
-💡 Если days не указан, по умолчанию продлевается на 31 день
-
-/deleteuser <username> - Удалить все данные пользователя из базы данных
-Пример: /deleteuser @username
-⚠️ ВНИМАНИЕ: Удаляет все данные пользователя (конфиги, напоминания, пользователя)
-
-/users - Показать список всех пользователей
-
-/sync_reminders - Синхронизировать напоминания из x-ui
-
-/cleardb - Очистить всю базу данных (удалить все данные)
-
-💡 Username можно указывать с @ или без него.
-"""
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(ADMIN_HELP_TEXT)
 
 
+@require_admin
 async def admin_add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Добавить пользователя (админ)"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
     if len(context.args) < 2:
         await update.message.reply_text(
             "❌ Использование: /adduser <username> <limit>\n"
@@ -418,9 +619,9 @@ async def admin_add_user_command(update: Update, context: ContextTypes.DEFAULT_T
         )
         
         # Попробуем найти пользователя в базе по username
-        user = db.get_user_by_username(username)
+        user = await asyncio.to_thread(db.get_user_by_username, username)
         if user:
-            db.set_config_limit(user['user_id'], limit)
+            await asyncio.to_thread(db.set_config_limit, user['user_id'], limit)
             await update.message.reply_text(
                 f"✅ Пользователь @{username} найден. Лимит установлен: {limit}"
             )
@@ -437,14 +638,9 @@ async def admin_add_user_command(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
+@require_admin
 async def admin_set_limit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Установить лимит конфигов (админ)"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
     if len(context.args) < 2:
         await update.message.reply_text(
             "❌ Использование: /setlimit <username> <limit>\n"
@@ -456,7 +652,7 @@ async def admin_set_limit_command(update: Update, context: ContextTypes.DEFAULT_
         username = context.args[0].lstrip('@')
         limit = int(context.args[1])
         
-        user = db.get_user_by_username(username)
+        user = await asyncio.to_thread(db.get_user_by_username, username)
         if not user:
             await update.message.reply_text(
                 f"❌ Пользователь @{username} не найден в базе.\n"
@@ -464,7 +660,7 @@ async def admin_set_limit_command(update: Update, context: ContextTypes.DEFAULT_
             )
             return
         
-        db.set_config_limit(user['user_id'], limit)
+        await asyncio.to_thread(db.set_config_limit, user['user_id'], limit)
         await update.message.reply_text(
             f"✅ Лимит для @{username} установлен: {limit} конфигов"
         )
@@ -485,21 +681,16 @@ async def admin_set_limit_command(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
+@require_admin
 async def admin_list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать список всех пользователей (админ)"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
-    users = db.get_all_users()
+    users = await asyncio.to_thread(db.get_all_users)
     
     if not users:
         await update.message.reply_text("📭 В базе нет пользователей.")
         return
     
-    text = "📋 Список пользователей:\n\n"
+    parts = ["📋 Список пользователей:\n\n"]
     
     for user in users:
         user_id_db = user.get("user_id")
@@ -509,73 +700,44 @@ async def admin_list_users_command(update: Update, context: ContextTypes.DEFAULT
         created = user.get("configs_created", 0)
         is_admin_user = "🔧" if user.get("is_admin") else ""
         
-        text += f"{is_admin_user} @{username} ({full_name})\n"
-        text += f"   ID: {user_id_db}\n"
-        text += f"   Лимит: {limit} | Использовано: {created}\n"
-        text += "─" * 30 + "\n\n"
+        parts.append(
+            f"{is_admin_user} @{username} ({full_name})\n"
+            f"   ID: {user_id_db}\n"
+            f"   Лимит: {limit} | Использовано: {created}\n"
+            f"{USERS_SEPARATOR}"
+        )
     
-    await update.message.reply_text(text)
+    await update.message.reply_text("".join(parts))
 
 
+@require_admin
 async def admin_clear_database_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Очистить всю базу данных (админ)"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
     try:
-        # Получаем соединение с базой данных
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Получаем список всех таблиц
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
+        cleared_tables = await asyncio.to_thread(db.clear_all_tables)
+        invalidate_access_cache()
         
-        if not tables:
+        if not cleared_tables:
             await update.message.reply_text("ℹ️ База данных пуста.")
-            conn.close()
             return
         
-        # Отключаем проверку внешних ключей для быстрой очистки
-        cursor.execute("PRAGMA foreign_keys = OFF;")
-        
-        # Очищаем каждую таблицу
-        cleared_tables = []
-        for table in tables:
-            table_name = table[0]
-            cursor.execute(f"DELETE FROM {table_name};")
-            cursor.execute(f"DELETE FROM sqlite_sequence WHERE name='{table_name}';")  # Сбрасываем автоинкремент
-            cleared_tables.append(table_name)
-        
-        # Включаем обратно проверку внешних ключей
-        cursor.execute("PRAGMA foreign_keys = ON;")
-        
-        conn.commit()
-        conn.close()
-        
-        result_text = f"✅ База данных успешно очищена!\n\n"
-        result_text += f"📋 Очищено таблиц: {len(cleared_tables)}\n"
+        parts = [
+            "✅ База данных успешно очищена!\n\n",
+            f"📋 Очищено таблиц: {len(cleared_tables)}\n",
+        ]
         for table_name in cleared_tables:
-            result_text += f"• {table_name}\n"
+            parts.append(f"• {table_name}\n")
         
-        await update.message.reply_text(result_text)
+        await update.message.reply_text("".join(parts))
         
     except Exception as e:
         logger.error(f"Ошибка при очистке базы данных: {e}", exc_info=True)
         await update.message.reply_text(f"❌ Ошибка при очистке базы данных: {str(e)}")
 
 
+@require_admin
 async def admin_delete_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удалить все данные пользователя из базы (админ)"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
     if len(context.args) < 1:
         await update.message.reply_text(
             "❌ Использование: /deleteuser <username>\n"
@@ -589,7 +751,8 @@ async def admin_delete_user_command(update: Update, context: ContextTypes.DEFAUL
         target_username = context.args[0]
         
         # Удаляем данные пользователя
-        success, message, user_id = db.delete_user_data(target_username)
+        success, message, user_id = await asyncio.to_thread(db.delete_user_data, target_username)
+        invalidate_access_cache()
         
         if success:
             await update.message.reply_text(message)
@@ -601,14 +764,9 @@ async def admin_delete_user_command(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
+@require_admin
 async def admin_extend_config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Продлить срок действия конфига на +31 день (админ)"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
     if len(context.args) < 1:
         await update.message.reply_text(
             "❌ Использование: /extend <username или email> [days]\n"
@@ -627,18 +785,20 @@ async def admin_extend_config_command(update: Update, context: ContextTypes.DEFA
         
         # Определяем, что передано: username или email с номером
         # Если содержит _ и число в конце (например, username_1), это email
-        import re
-        email_pattern = re.compile(r'^(.+)_(\d+)$')
-        match = email_pattern.match(target_input)
+        match = EMAIL_WITH_NUMBER_RE.match(target_input)
         
         email = None
+        client = None
         if match:
             # Это email с номером (например, iccceee_boy_1)
             email = target_input
             logger.info(f"Используется email с номером: {email}")
         else:
             # Это username, нужно найти конфиги пользователя
-            user_configs = xui_client.get_user_configs(inbound_id, target_input)
+            # Трафик для продления не нужен - без него это поиск по закешированным клиентам
+            user_configs = await asyncio.to_thread(
+                xui_client.get_user_configs, inbound_id, target_input, with_traffic=False
+            )
             if not user_configs:
                 await update.message.reply_text(
                     f"❌ Конфиги для @{target_input} не найдены в x-ui.\n"
@@ -650,11 +810,12 @@ async def admin_extend_config_command(update: Update, context: ContextTypes.DEFA
             # Используем последний конфиг (с максимальным номером)
             last_config = user_configs[-1]
             email = last_config["email"]
+            client = last_config["client"]
             logger.info(f"Найден последний конфиг для {target_input}: {email}")
         
-        # Проверяем, существует ли конфиг для этого email
-        clients = xui_client.get_inbound_clients(inbound_id)
-        client = next((c for c in clients if c.get("email") == email), None)
+        # Для email проверяем по индексу, существует ли конфиг
+        if client is None:
+            client = await asyncio.to_thread(xui_client.get_client_by_email, email, inbound_id)
         
         if not client:
             await update.message.reply_text(
@@ -664,33 +825,21 @@ async def admin_extend_config_command(update: Update, context: ContextTypes.DEFA
             return
         
         # Получаем текущий срок действия
-        current_expiry = client.get("expireTime", 0)
-        from datetime import datetime
+        current_expiry = client.get("expiryTime", 0)
         if current_expiry > 0:
-            current_expiry_date = datetime.fromtimestamp(current_expiry / 1000)
-            current_expiry_str = current_expiry_date.strftime("%Y-%m-%d %H:%M")
+            current_expiry_str = format_timestamp(current_expiry)
         else:
             current_expiry_str = "Без ограничений"
         
         # Продлеваем конфиг
-        await update.message.reply_text(f"⏳ Продлеваю конфиг для {email} на {add_days} дней...")
+        await update.message.chat.send_action(ChatAction.TYPING)
         
-        success = xui_client.update_client_expiry(inbound_id, email, add_days)
+        # Новый срок действия возвращает сам update_client_expiry,
+        # повторно запрашивать список клиентов не нужно
+        new_expiry = await asyncio.to_thread(xui_client.update_client_expiry, inbound_id, email, add_days)
         
-        if success:
-            # Получаем новый срок действия
-            clients = xui_client.get_inbound_clients(inbound_id)
-            client = next((c for c in clients if c.get("email") == email), None)
-            
-            if client:
-                new_expiry = client.get("expireTime", 0)
-                if new_expiry > 0:
-                    new_expiry_date = datetime.fromtimestamp(new_expiry / 1000)
-                    new_expiry_str = new_expiry_date.strftime("%Y-%m-%d %H:%M")
-                else:
-                    new_expiry_str = "Без ограничений"
-            else:
-                new_expiry_str = "Не удалось получить"
+        if new_expiry:
+            new_expiry_str = format_timestamp(new_expiry)
             
             result_text = f"""
 ✅ Конфиг для {email} успешно продлен!
@@ -715,41 +864,31 @@ async def admin_extend_config_command(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
+@require_admin
 async def admin_sync_reminders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Синхронизировать напоминания из x-ui (админ)"""
-    username = update.effective_user.username
-    
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
     try:
-        await update.message.reply_text("⏳ Синхронизирую напоминания из x-ui...")
+        await update.message.chat.send_action(ChatAction.TYPING)
         
-        users = db.get_all_users()
-        synced_count = 0
+        users = await asyncio.to_thread(db.get_all_users)
         
-        for user in users:
-            user_id_db = user.get("user_id")
-            db.sync_reminders_from_xui(xui_client, user_id_db)
-            synced_count += 1
+        user_ids = [user.get("user_id") for user in users]
+        
+        # Все пользователи синхронизируются одной транзакцией
+        reminders_count = await asyncio.to_thread(db.sync_reminders_bulk, xui_client, user_ids)
         
         await update.message.reply_text(
-            f"✅ Синхронизация завершена. Обработано пользователей: {synced_count}"
+            f"✅ Синхронизация завершена. Обработано пользователей: {len(user_ids)}\n"
+            f"⏰ Обновлено напоминаний: {reminders_count}"
         )
         
     except Exception as e:
         logger.error(f"Ошибка в admin_sync_reminders_command: {e}")
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
+@require_admin
 async def admin_allowed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Добавить пользователя (админ)"""
-    username = update.effective_user.username
-
-    if not is_admin(username):
-        #await update.message.reply_text("❌ У вас нет прав администратора.")
-        return
-    
     if len(context.args) < 1:
         await update.message.reply_text(
             "❌ Использование: /allowed <username>\n"
@@ -761,7 +900,8 @@ async def admin_allowed_command(update: Update, context: ContextTypes.DEFAULT_TY
         username = context.args[0].lstrip('@')
         
         # Попробуем найти пользователя в базе по username
-        user = db.add_allowed_user(username)
+        user = await asyncio.to_thread(db.add_allowed_user, username)
+        invalidate_access_cache()
         if user:
             await update.message.reply_text(
                 f"✅ Пользователь @{username} доступ предоставлен."
@@ -777,44 +917,38 @@ async def admin_allowed_command(update: Update, context: ContextTypes.DEFAULT_TY
 
 # ========== ОСНОВНЫЕ КОМАНДЫ ==========
 
+@require_access
 async def list_inbounds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /list - показать список inbounds"""
-    username = update.effective_user.username
-    
-    if not check_access(username):
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
-        return
-    
     try:
-        loading_msg = await update.message.reply_text("⏳ Получаю список серверов...")
-        inbounds = xui_client.get_inbounds()
+        # Вместо сообщения "⏳ ..." с последующим редактированием показываем статус "печатает"
+        await update.message.chat.send_action(ChatAction.TYPING)
+        inbounds = await asyncio.to_thread(xui_client.get_inbounds)
         
         if not inbounds:
-            await loading_msg.edit_text("❌ Не удалось получить список inbounds или список пуст.")
+            await update.message.reply_text("❌ Не удалось получить список inbounds или список пуст.")
             return
         
-        text = "📋 Список доступных inbounds:\n\n"
+        parts = ["📋 Список доступных inbounds:\n\n"]
         keyboard = []
         
-        for inbound in inbounds:
+        # Кнопки для каждого inbound (2 кнопки в ряд) собираем в том же проходе
+        buttons_per_row = 2
+        for i, inbound in enumerate(inbounds):
             inbound_id = inbound.get("id")
             remark = inbound.get("remark", f"Inbound {inbound_id}")
             protocol = inbound.get("protocol", "unknown")
             port = inbound.get("port", "N/A")
             traffic = inbound.get("up", 0) + inbound.get("down", 0)
             
-            text += f"🆔 ID: {inbound_id}\n"
-            text += f"📝 Название: {remark}\n"
-            text += f"🔌 Протокол: {protocol.upper()}\n"
-            text += f"🚪 Порт: {port}\n"
-            text += f"📊 Трафик: {traffic / (1024**3):.2f} GB\n"
-            text += "─" * 20 + "\n\n"
-        
-        # Добавляем кнопки для каждого inbound в одну строку (2 кнопки в ряд)
-        buttons_per_row = 2
-        for i, inbound in enumerate(inbounds):
-            inbound_id = inbound.get("id")
-            remark = inbound.get("remark", f"Inbound {inbound_id}")
+            parts.append(
+                f"🆔 ID: {inbound_id}\n"
+                f"📝 Название: {remark}\n"
+                f"🔌 Протокол: {protocol.upper()}\n"
+                f"🚪 Порт: {port}\n"
+                f"📊 Трафик: {traffic / GIB:.2f} GB\n"
+                f"{SEPARATOR}"
+            )
             
             if i % buttons_per_row == 0:
                 # Начинаем новую строку
@@ -828,8 +962,10 @@ async def list_inbounds(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             )
         
+        text = "".join(parts)
+        
         if not keyboard or not any(keyboard):
-            await loading_msg.edit_text("❌ Не удалось создать кнопки.")
+            await update.message.reply_text("❌ Не удалось создать кнопки.")
             return
         
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -837,24 +973,19 @@ async def list_inbounds(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Отправляю список inbounds с {len(keyboard)} строками кнопок, всего {total_buttons} кнопок")
         
         try:
-            await loading_msg.edit_text(text, reply_markup=reply_markup)
+            await update.message.reply_text(text, reply_markup=reply_markup)
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения с кнопками: {e}")
-            await loading_msg.edit_text(f"❌ Ошибка при отправке кнопок: {str(e)}")
+            await update.message.reply_text(f"❌ Ошибка при отправке кнопок: {str(e)}")
         
     except Exception as e:
         logger.error(f"Ошибка в list_inbounds: {e}")
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
+@require_access
 async def list_clients(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /clients"""
-    username = update.effective_user.username
-    
-    if not check_access(username):
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
-        return
-    
     if not context.args:
         await update.message.reply_text(
             "❌ Укажите ID inbound.\nПример: /clients 1"
@@ -863,28 +994,26 @@ async def list_clients(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         inbound_id = int(context.args[0])
-        await update.message.reply_text(f"⏳ Получаю список клиентов для inbound {inbound_id}...")
+        await update.message.chat.send_action(ChatAction.TYPING)
         
-        clients = xui_client.get_inbound_clients(inbound_id)
+        clients = await asyncio.to_thread(xui_client.get_inbound_clients, inbound_id)
         
         if not clients:
             await update.message.reply_text(f"❌ Не найдено клиентов для inbound {inbound_id}.")
             return
         
-        text = f"📋 Клиенты для inbound {inbound_id}:\n\n"
+        parts = [f"📋 Клиенты для inbound {inbound_id}:\n\n"]
         keyboard = []
         
         for client in clients:
             email = client.get("email", "N/A")
             total = client.get("total", 0)
-            expire = client.get("expireTime", 0)
+            expire = client.get("expiryTime", 0)
             
-            text += f"📧 Email: {email}\n"
-            text += f"📊 Трафик: {total / (1024**3):.2f} GB\n"
+            parts.append(f"📧 Email: {email}\n📊 Трафик: {total / GIB:.2f} GB\n")
             if expire > 0:
-                expire_date = datetime.fromtimestamp(expire / 1000)
-                text += f"⏰ Истекает: {expire_date.strftime('%Y-%m-%d %H:%M')}\n"
-            text += "─" * 20 + "\n\n"
+                parts.append(f"⏰ Истекает: {format_timestamp(expire)}\n")
+            parts.append(SEPARATOR)
             
             # Добавляем кнопку для получения конфигурации
             keyboard.append([
@@ -895,7 +1024,7 @@ async def list_clients(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await update.message.reply_text("".join(parts), reply_markup=reply_markup)
         
     except ValueError:
         await update.message.reply_text("❌ ID inbound должен быть числом.")
@@ -904,15 +1033,47 @@ async def list_clients(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
+async def _get_config_text(user_id: int, email: str) -> str:
+    """Найти конфигурацию по email, записать ее выдачу и вернуть текст ответа для /get"""
+    # Находим inbound и клиента для этого email по индексу
+    email_index = await asyncio.to_thread(xui_client.get_email_index)
+    entry = email_index.get(email)
+    if entry is None:
+        # Клиент мог быть создан после последнего обновления кеша
+        email_index = await asyncio.to_thread(xui_client.get_email_index, use_cache=False)
+        entry = email_index.get(email)
+
+    if entry is None:
+        return f"❌ Не удалось найти конфигурацию для {email}."
+
+    target_inbound, client = entry
+    target_inbound_id = target_inbound.get("id")
+    protocol = target_inbound.get("protocol", "vless").lower()
+    config = await asyncio.to_thread(xui_client.get_client_config, target_inbound_id, email, protocol)
+
+    if not config:
+        return f"❌ Не удалось получить конфигурацию для {email}."
+
+    # Записываем выдачу конфига и напоминание одной транзакцией, заодно получаем обновленный счетчик
+    user = await asyncio.to_thread(
+        db.finalize_issue, user_id, email, target_inbound_id, client.get("expiryTime")
+    )
+
+    # Информация о лимите отправляется в том же сообщении, что и конфигурация
+    result_text = f"✅ Конфигурация для {email}:\n\n{config}"
+    if user:
+        limit = user.get("config_limit", 0)
+        created = user.get("configs_created", 0)
+        remaining = max(0, limit - created)
+        result_text += f"\n\n📊 Осталось конфигов: {remaining}/{limit}"
+
+    return result_text
+
+
+@require_access
 async def get_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /get"""
     user_id = update.effective_user.id
-    username = update.effective_user.username
-    
-    if not check_access(username):
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
-        return
-    
     if not context.args:
         await update.message.reply_text(
             "❌ Укажите email клиента.\nПример: /get user@example.com"
@@ -920,7 +1081,7 @@ async def get_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Проверяем лимит
-    can_create, message = db.can_create_config(user_id)
+    can_create, message = await asyncio.to_thread(db.can_create_config, user_id)
     if not can_create:
         await update.message.reply_text(f"❌ {message}")
         return
@@ -928,131 +1089,82 @@ async def get_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
     email = " ".join(context.args)
     
     try:
-        await update.message.reply_text(f"⏳ Получаю конфигурацию для {email}...")
-        
-        # Находим inbound для этого email
-        inbounds = xui_client.get_inbounds()
-        target_inbound = None
-        target_inbound_id = None
-        
-        for inbound in inbounds:
-            inbound_id = inbound.get("id")
-            clients = xui_client.get_inbound_clients(inbound_id)
-            if any(c.get("email") == email for c in clients):
-                target_inbound = inbound
-                target_inbound_id = inbound_id
-                break
-        
-        if not target_inbound:
-            await update.message.reply_text(
-                f"❌ Не удалось найти конфигурацию для {email}."
-            )
-            return
-        
-        protocol = target_inbound.get("protocol", "vless").lower()
-        config = xui_client.get_client_config(target_inbound_id, email, protocol)
-        
-        if not config:
-            await update.message.reply_text(
-                f"❌ Не удалось получить конфигурацию для {email}."
-            )
-            return
-        
-        # Записываем выдачу конфига
-        db.record_issued_config(user_id, email, target_inbound_id)
-        
-        # Получаем информацию о клиенте для напоминаний
-        clients = xui_client.get_inbound_clients(target_inbound_id)
-        client = next((c for c in clients if c.get("email") == email), None)
-        
-        if client and client.get("expireTime", 0) > 0:
-            db.add_reminder(user_id, email, target_inbound_id, client.get("expireTime"))
-        
-        # Не используем Markdown для конфигурации, так как она содержит специальные символы
-        await update.message.reply_text(
-            f"✅ Конфигурация для {email}:\n\n"
-            f"{config}"
+        # Вместо отдельного сообщения "⏳ ..." показываем статус "печатает":
+        # ответ придет одним сообщением
+        await update.message.chat.send_action(ChatAction.TYPING)
+        
+        # Одновременные одинаковые /get одного пользователя выполняются один раз:
+        # конфиг запрашивается и записывается в базу однократно, ответ получает каждый
+        result_text = await run_single_flight(
+            ("get_config", user_id, email), lambda: _get_config_text(user_id, email)
         )
         
-        # Также отправляем как обычный текст для удобства копирования
-        await update.message.reply_text(config)
-        
-        # Обновляем информацию о лимите
-        user = db.get_user(user_id)
-        if user:
-            limit = user.get("config_limit", 0)
-            created = user.get("configs_created", 0)
-            remaining = max(0, limit - created)
-            await update.message.reply_text(
-                f"📊 Осталось конфигов: {remaining}/{limit}"
-            )
+        # Не используем Markdown для конфигурации, так как она содержит специальные символы
+        await update.message.reply_text(result_text)
         
     except Exception as e:
         logger.error(f"Ошибка в get_config: {e}")
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
+@require_access
 async def create_client(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /create - создать нового клиента"""
     user_id = update.effective_user.id
     username = update.effective_user.username
     
-    if not check_access(username):
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
+    # Если указан inbound_id в аргументах, создаем сразу.
+    # Лимит проверяет _create_client_for_inbound до первого запроса к x-ui
+    if context.args:
+        try:
+            inbound_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ ID inbound должен быть числом.")
+            return
+        await _create_client_for_inbound(update, context, user_id, username, inbound_id)
         return
     
     # Проверяем лимит
-    can_create, message = db.can_create_config(user_id)
+    can_create, message = await asyncio.to_thread(db.can_create_config, user_id)
     if not can_create:
         await update.message.reply_text(f"❌ {message}")
         return
     
-    # Если указан inbound_id в аргументах, создаем сразу
-    if context.args:
-        try:
-            inbound_id = int(context.args[0]) if context.args else DEFAULT_INBOUND_ID
-            await _create_client_for_inbound(update, context, user_id, username, inbound_id)
-            return
-        except ValueError:
-            await update.message.reply_text("❌ ID inbound должен быть числом.")
-            return
-    
     return
 
     # Иначе показываем список inbounds с кнопками
     try:
-        loading_msg = await update.message.reply_text("⏳ Получаю список серверов...")
-        inbounds = xui_client.get_inbounds()
+        # Вместо сообщения "⏳ ..." с последующим редактированием показываем статус "печатает"
+        await update.message.chat.send_action(ChatAction.TYPING)
+        inbounds = await asyncio.to_thread(xui_client.get_inbounds)
         
         logger.info(f"Получено inbounds: {len(inbounds) if inbounds else 0}")
         
         if not inbounds:
-            await loading_msg.edit_text(
+            await update.message.reply_text(
                 "❌ Не удалось получить список inbounds или список пуст.\n"
                 "Проверьте подключение к x-ui панели."
             )
             return
         
-        text = "📋 Выберите сервер для создания клиента:\n\n"
+        parts = ["📋 Выберите сервер для создания клиента:\n\n"]
         keyboard = []
         
-        for inbound in inbounds:
+        # Кнопки для каждого inbound (2 кнопки в ряд) собираем в том же проходе
+        buttons_per_row = 2
+        for i, inbound in enumerate(inbounds):
             inbound_id = inbound.get("id")
             remark = inbound.get("remark", f"Inbound {inbound_id}")
             protocol = inbound.get("protocol", "unknown")
             port = inbound.get("port", "N/A")
             
-            text += f"🆔 ID: {inbound_id}\n"
-            text += f"📝 Название: {remark}\n"
-            text += f"🔌 Протокол: {protocol.upper()}\n"
-            text += f"🚪 Порт: {port}\n"
-            text += "─" * 20 + "\n\n"
-        
-        # Добавляем кнопки для каждого inbound в одну строку (2 кнопки в ряд)
-        buttons_per_row = 2
-        for i, inbound in enumerate(inbounds):
-            inbound_id = inbound.get("id")
-            remark = inbound.get("remark", f"Inbound {inbound_id}")
+            parts.append(
+                f"🆔 ID: {inbound_id}\n"
+                f"📝 Название: {remark}\n"
+                f"🔌 Протокол: {protocol.upper()}\n"
+                f"🚪 Порт: {port}\n"
+                f"{SEPARATOR}"
+            )
             
             if i % buttons_per_row == 0:
                 # Начинаем новую строку
@@ -1066,8 +1178,10 @@ async def create_client(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             )
         
+        text = "".join(parts)
+        
         if not keyboard or not any(keyboard):
-            await loading_msg.edit_text(
+            await update.message.reply_text(
                 "❌ Не удалось создать кнопки для выбора сервера."
             )
             return
@@ -1077,10 +1191,10 @@ async def create_client(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Отправляю сообщение с {len(keyboard)} строками кнопок, всего {total_buttons} кнопок")
         
         try:
-            await loading_msg.edit_text(text, reply_markup=reply_markup)
+            await update.message.reply_text(text, reply_markup=reply_markup)
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения с кнопками: {e}")
-            await loading_msg.edit_text(f"❌ Ошибка при отправке кнопок: {str(e)}")
+            await update.message.reply_text(f"❌ Ошибка при отправке кнопок: {str(e)}")
         
     except Exception as e:
         logger.error(f"Ошибка в create_client: {e}")
@@ -1088,40 +1202,56 @@ async def create_client(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def _create_client_for_inbound(update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                                     user_id: int, username: Optional[str], inbound_id: int):
-    """Создать клиента для указанного inbound"""
+                                     user_id: int, username: Optional[str], inbound_id: int,
+                                     inbound: Optional[dict] = None):
+    """Создать клиента для указанного inbound
+    
+    inbound можно передать, если он уже получен вызывающим кодом.
+    """
+    # callback_query есть только у нажатий на кнопки, для команды /create он None
+    query = update.callback_query
 
     try:
         # Проверяем лимит еще раз
-        can_create, message = db.can_create_config(user_id)
+        can_create, message = await asyncio.to_thread(db.can_create_config, user_id)
 
         if not can_create:
-            if hasattr(update, 'message') and update.message:
+            if query:
+                # Callback уже подтвержден в button_callback, поэтому показываем причину в сообщении с меню
+                await query.edit_message_text(f"❌ {message}", reply_markup=MAIN_MENU_MARKUP)
+            else:
                 await update.message.reply_text(f"❌ {message}")
-            elif hasattr(update, 'callback_query'):
-                await update.callback_query.answer(f"❌ {message}", show_alert=True)
             return
         
-        # Показываем сообщение о создании
-        if hasattr(update, 'callback_query'):
-            await update.callback_query.answer("⏳ Создаю конфиг...")
-            await update.callback_query.edit_message_text("⏳ Создаю конфиг...")
+        # Для кнопки показываем статус в сообщении с меню, и все ответы редактируют его.
+        # Для команды показываем "печатает" и отвечаем одним сообщением с результатом
+        if query:
+            await query.edit_message_text("⏳ Создаю конфиг...")
+            respond = query.message.edit_text
         else:
-            await update.message.reply_text("⏳ Создаю конфиг...")
+            await update.message.chat.send_action(ChatAction.TYPING)
+            
+            async def respond(text: str):
+                msg = await update.message.reply_text(text)
+                # Сохраняем message_id для возможного удаления при /start
+                await save_bot_message_id(context, msg.message_id)
         
         # Получаем следующий доступный email с номером (username_1, username_2, и т.д.)
         if not username:
-            error_msg = "❌ У вас не установлен username в настройках Telegram."
-            if hasattr(update, 'callback_query'):
-                await update.callback_query.edit_message_text(error_msg)
-            else:
-                await update.message.reply_text(error_msg)
+            await respond("❌ У вас не установлен username в настройках Telegram.")
             return
         
-        # Вычисляем expire_time в миллисекундах (31 день)
+        # Inbound нужен для протокола, порта и streamSettings конфигурации.
+        # Эти поля не меняются при добавлении клиента, поэтому берем его заранее (из кеша)
+        if inbound is None:
+            inbound = await asyncio.to_thread(xui_client.get_inbound, inbound_id)
         
-        expire_date = datetime.now() + timedelta(days=CONFIG_EXPIRY_DAYS)
-        expire_time = int(expire_date.timestamp() * 1000)
+        if not inbound:
+            await respond("❌ Не удалось получить информацию о inbound.")
+            return
+        
+        # Вычисляем expire_time в миллисекундах (31 день)
+        expire_time = int((datetime.now() + CONFIG_EXPIRY_DELTA).timestamp() * 1000)
         
         # Пытаемся создать конфиг с повторными попытками (на случай race condition)
         max_attempts = 3
@@ -1132,24 +1262,28 @@ async def _create_client_for_inbound(update: Update, context: ContextTypes.DEFAU
         for attempt in range(max_attempts):
             # Получаем следующий доступный email, исключая уже попробованные
             logger.info(f"Попытка {attempt + 1}/{max_attempts}: Исключаемые email: {attempted_emails}")
-            email = xui_client.get_next_available_email(inbound_id, username, excluded_emails=attempted_emails)
+            email = await asyncio.to_thread(xui_client.get_next_available_email, inbound_id, username, excluded_emails=attempted_emails)
             logger.info(f"Попытка {attempt + 1}/{max_attempts}: Получен email {email} для пользователя {username}")
             
             # Добавляем email в список попробованных
             attempted_emails.append(email)
             logger.info(f"Попытка {attempt + 1}/{max_attempts}: Обновлен список attempted_emails: {attempted_emails}")
             
-            # Пытаемся добавить клиента
-            success = xui_client.add_client_to_inbound(inbound_id, email, expire_time=expire_time)
+            # Пытаемся добавить клиента. UUID задаем сами, чтобы собрать конфигурацию
+            # без повторного запроса списка inbounds после создания
+            client_uuid = str(uuid.uuid4())
+            success = await asyncio.to_thread(
+                xui_client.add_client_to_inbound, inbound_id, email, uuid=client_uuid, expire_time=expire_time
+            )
             
             if success:
                 logger.info(f"✅ Конфиг успешно создан с email {email}")
                 break
-            else:
+            elif attempt + 1 < max_attempts:
                 logger.warning(f"⚠️ Попытка {attempt + 1} не удалась для email {email}, пробуем следующий...")
-                # Увеличиваем задержку перед следующей попыткой, чтобы x-ui успел обновить данные
-                import asyncio
-                await asyncio.sleep(1.5)  # Увеличено с 0.5 до 1.5 секунд
+                # Экспоненциальная задержка со случайным разбросом, чтобы x-ui успел обновить данные,
+                # а одновременные попытки разных пользователей не повторялись синхронно
+                await asyncio.sleep(random.uniform(0, CREATE_RETRY_BASE_DELAY * (2 ** attempt)))
         
         if not success:
             attempted_list = ", ".join(attempted_emails) if attempted_emails else "нет"
@@ -1159,26 +1293,12 @@ async def _create_client_for_inbound(update: Update, context: ContextTypes.DEFAU
                 f"💡 Возможно, все доступные номера заняты или произошла ошибка."
             )
             logger.error(f"Не удалось создать клиента для {username} после {max_attempts} попыток. Попробованные email: {attempted_list}")
-            if hasattr(update, 'callback_query'):
-                await update.callback_query.edit_message_text(error_msg)
-            else:
-                await update.message.reply_text(error_msg)
-            return
-        
-        # Получаем конфигурацию
-        inbounds = xui_client.get_inbounds()
-        inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
-        
-        if not inbound:
-            error_msg = "❌ Не удалось получить информацию о inbound."
-            if hasattr(update, 'callback_query'):
-                await update.callback_query.edit_message_text(error_msg)
-            else:
-                await update.message.reply_text(error_msg)
+            await respond(error_msg)
             return
         
+        # Собираем конфигурацию из известного inbound и только что созданного клиента
         protocol = inbound.get("protocol", "vless").lower()
-        config = xui_client.get_client_config(inbound_id, email, protocol)
+        config = xui_client.build_client_config(inbound, {"id": client_uuid, "email": email}, protocol)
         
         if not config:
             error_msg = (
@@ -1186,280 +1306,216 @@ async def _create_client_for_inbound(update: Update, context: ContextTypes.DEFAU
                 f"Email: {email}\n"
                 f"Inbound ID: {inbound_id}"
             )
-            if hasattr(update, 'callback_query'):
-                await update.callback_query.edit_message_text(error_msg)
-            else:
-                await update.message.reply_text(error_msg)
+            await respond(error_msg)
             return
         
-        # Записываем выдачу конфига
-        db.record_issued_config(user_id, email, inbound_id)
+        # Записываем выдачу конфига и напоминание, заодно получаем обновленный счетчик
+        user = await asyncio.to_thread(db.finalize_issue, user_id, email, inbound_id, expire_time)
         
-        # Отправляем результат
+        # Отправляем результат, конфигурацию и информацию о лимите одним сообщением
         # Не используем Markdown для конфигурации, так как она содержит специальные символы
         result_text = (
             f"✅ Клиент успешно создан!\n\n"
             f"📧 Email: {email}\n"
             f"🆔 Inbound ID: {inbound_id}\n\n"
-            f"Конфигурация:"
+            f"Конфигурация:\n{config}"
         )
         
-        if hasattr(update, 'callback_query'):
-            chat_id = update.callback_query.message.chat_id
-            await update.callback_query.edit_message_text(result_text)
-            # Отправляем конфигурацию отдельным сообщением
-            config_msg = await context.bot.send_message(chat_id=chat_id, text=config)
-            # Сохраняем message_id для возможного удаления
-            await save_bot_message_id(context, user_id, config_msg.message_id)
-        else:
-            await update.message.reply_text(result_text)
-            config_msg = await update.message.reply_text(config)
-            # Сохраняем message_id для возможного удаления
-            await save_bot_message_id(context, user_id, config_msg.message_id)
-        
-        # Обновляем информацию о лимите
-        user = db.get_user(user_id)
         if user:
             limit = user.get("config_limit", 1)
             created = user.get("configs_created", 0)
             remaining = max(0, limit - created)
-            limit_msg = f"📊 Осталось конфигов: {remaining}/{limit}"
-            
-            if hasattr(update, 'callback_query'):
-                chat_id = update.callback_query.message.chat_id
-                await context.bot.send_message(chat_id=chat_id, text=limit_msg)
-            else:
-                await update.message.reply_text(limit_msg)
+            result_text += f"\n\n📊 Осталось конфигов: {remaining}/{limit}"
+        
+        await respond(result_text)
         
     except Exception as e:
         logger.error(f"Ошибка в _create_client_for_inbound: {e}", exc_info=True)
         error_msg = f"❌ Ошибка: {str(e)}\n\nВозвращаюсь в главное меню..."
         
         # Показываем стартовое меню после ошибки
-        if hasattr(update, 'callback_query'):
-            query = update.callback_query
-            user_id = query.from_user.id
-            username = query.from_user.username
-            
-            # Получаем информацию о пользователе
-            user = db.get_user(user_id)
-            limit = user.get("config_limit", 0) if user else 0
-            created = user.get("configs_created", 0) if user else 0
-            
-            welcome_text = """
-🤖 Привет! Я бот для получения VPN конфигураций.
-
-📋 Доступные команды:
-• Создание конфига
-• Скачивание конфига
-• Информация о конфиге
-• Связь с администратором
-
-💡 Используйте кнопки 👇 для работы с ботом.
-"""
-            
-            # Добавляем кнопки для быстрого доступа
-            keyboard = [
-                [
-                    InlineKeyboardButton("✨ Создать конфиг", callback_data="create_config")
-                ],
-                [
-                    InlineKeyboardButton("📥 Скачать конфиг", callback_data="download_config")
-                ],
-                [
-                    InlineKeyboardButton("📊 Информация о конфиге", callback_data="config_info")
-                ],
-                [
-                    InlineKeyboardButton("💬 Связь с администратором", callback_data="contact_admin")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(error_msg + "\n\n" + welcome_text, reply_markup=reply_markup)
+        if query:
+            await query.edit_message_text(error_msg + "\n\n" + MENU_TEXT, reply_markup=MAIN_MENU_MARKUP)
         else:
             await update.message.reply_text(error_msg)
             # Вызываем start для показа меню
             await start(update, context)
 
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на inline кнопки"""
+async def _handle_create_config(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                user_id: int, username: Optional[str]):
+    """Кнопка меню: создать конфиг"""
+    # Создаем конфиг сразу для захардкоженного inbound
+    await _create_client_for_inbound(update, context, user_id, username, DEFAULT_INBOUND_ID)
+
+
+async def _fetch_download_configs(inbound_id: int, username: str):
+    """Получить из x-ui конфиги пользователя для скачивания
+    
+    Returns:
+        (user_configs, inbound, found_configs), где found_configs - пары (config_data, config)
+    """
+    # Конфиги пользователя и inbound (для протокола) не зависят друг от друга,
+    # поэтому запрашиваем их параллельно
+    user_configs, inbound = await asyncio.gather(
+        asyncio.to_thread(xui_client.get_user_configs, inbound_id, username),
+        asyncio.to_thread(xui_client.get_inbound, inbound_id),
+    )
+    if not user_configs or not inbound:
+        return user_configs, inbound, []
+    
+    protocol = inbound.get("protocol", "vless").lower()
+    
+    # Получаем конфигурации всех конфигов пользователя параллельно
+    configs = await asyncio.gather(*(
+        asyncio.to_thread(xui_client.get_client_config, inbound_id, config_data["email"], protocol)
+        for config_data in user_configs
+    ))
+    found_configs = [
+        (config_data, config) for config_data, config in zip(user_configs, configs) if config
+    ]
+    return user_configs, inbound, found_configs
+
+
+async def _handle_download_config(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                  user_id: int, username: Optional[str]):
+    """Кнопка меню: отправить пользователю все его конфиги"""
     query = update.callback_query
-    user_id = query.from_user.id
-    username = query.from_user.username
     
-    if not check_access(username):
-        await query.answer("❌ У вас нет доступа к этому боту.", show_alert=True)
+    # Проверяем наличие username
+    if not username:
+        await query.edit_message_text(
+            "❌ У вас не установлен username в настройках Telegram.\n"
+            "💡 Установите username в настройках Telegram для получения конфига."
+        )
         return
     
-    await query.answer()
+    inbound_id = DEFAULT_INBOUND_ID
     
-    data = query.data
+    # Повторные нажатия, пока запрос к x-ui еще выполняется, ждут его результат и не запрашивают
+    # x-ui заново. Свое сообщение каждое нажатие обновляет само
+    user_configs, inbound, found_configs = await run_with_spinner(
+        query, "⏳ Получаю конфигурацию...",
+        run_single_flight(
+            ("download_config", inbound_id, username),
+            lambda: _fetch_download_configs(inbound_id, username)
+        )
+    )
     
-    #logger.info(f'button_callback: {data}')
+    if not user_configs:
+        await query.edit_message_text(
+            "❌ У вас нет созданных конфигов.\n"
+            "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
+        )
+        return
+    
+    if not inbound:
+        await query.edit_message_text("❌ Не удалось получить информацию о сервере.")
+        return
+    
+    for config_data, config in found_configs:
+        # Получаем информацию о клиенте для напоминаний
+        client = config_data["client"]
+        
+        # Выдачу конфига и напоминание записываем в фоне, пачкой с другими пользователями
+        await record_issued_config_later(
+            user_id, config_data["email"], inbound_id, client.get("expiryTime") if client else None
+        )
+    
+    if found_configs:
+        await query.edit_message_text(f"👇👇 Твой конфиг 👇👇")
+        
+        # Каждую конфигурацию отправляем отдельным сообщением для удобства копирования,
+        # повторно у x-ui их не запрашиваем. Отправка идет в фоне, обработчик не ждет ее
+        send_messages_in_background(
+            context, query.message.chat_id, user_id,
+            [config for _, config in found_configs]
+        )
+    else:
+        await query.edit_message_text(
+            "❌ Не удалось получить конфигурации.\n"
+            "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
+        )
 
-    try:
-        # Обработка кнопок меню
-        if data == "create_config":
-            # Создаем конфиг сразу для захардкоженного inbound
-            await _create_client_for_inbound(update, context, user_id, username, DEFAULT_INBOUND_ID)
-            return
-        elif data == "download_config":
-            await query.edit_message_text("⏳ Получаю конфигурацию...")
-            
-            # Проверяем наличие username
-            if not username:
-                await query.edit_message_text(
-                    "❌ У вас не установлен username в настройках Telegram.\n"
-                    "💡 Установите username в настройках Telegram для получения конфига."
-                )
-                return
-            
-            inbound_id = DEFAULT_INBOUND_ID
-            
-            # Получаем все конфиги пользователя
-            user_configs = xui_client.get_user_configs(inbound_id, username)
-            
-            if not user_configs:
-                await query.edit_message_text(
-                    "❌ У вас нет созданных конфигов.\n"
-                    "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
-                )
-                return
-            
-            # Получаем протокол из inbound
-            inbounds = xui_client.get_inbounds()
 
-            logger.info(f'Получил inbounds: {inbounds}')
-            inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
-            
-            if not inbound:
-                await query.edit_message_text("❌ Не удалось получить информацию о сервере.")
-                return
-            
-            protocol = inbound.get("protocol", "vless").lower()
-            
-            # Получаем все конфигурации для всех конфигов пользователя
-            configs_text = f"📥 Ваши конфигурации ({len(user_configs)} шт.):\n\n"
-            configs_found = 0
-            
-            for i, config_data in enumerate(user_configs, 1):
-                email = config_data["email"]
-                config = xui_client.get_client_config(inbound_id, email, protocol)
-                
-                if config:
-                    configs_found += 1
-                    # Записываем выдачу конфига
-                    db.record_issued_config(user_id, email, inbound_id)
-                    
-                    # Получаем информацию о клиенте для напоминаний
-                    client = config_data["client"]
-                    
-                    if client and client.get("expireTime", 0) > 0:
-                        db.add_reminder(user_id, email, inbound_id, client.get("expireTime"))
-                    
-                    # Добавляем конфигурацию в текст
-                    configs_text += f"📧 Конфиг #{i} ({email}):\n{config}\n\n"
-                    configs_text += "─" * 30 + "\n\n"
-            
-            if configs_found > 0:
-                # Отправляем все конфигурации одним сообщением
-                # await query.edit_message_text(configs_text)
-                await query.edit_message_text(f"👇👇 Твой конфиг 👇👇")
-                
-                # Также отправляем каждую конфигурацию отдельным сообщением для удобства копирования
-                for i, config_data in enumerate(user_configs, 1):
-                    email = config_data["email"]
-                    config = xui_client.get_client_config(inbound_id, email, protocol)
-                    
-                    if config:
-                        config_msg = await context.bot.send_message(
-                            chat_id=query.message.chat_id,
-                            text=f"{config}"
-                        )
-                        # Сохраняем message_id для возможного удаления
-                        await save_bot_message_id(context, user_id, config_msg.message_id)
-            else:
-                await query.edit_message_text(
-                    "❌ Не удалось получить конфигурации.\n"
-                    "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
-                )
-            return
-        elif data == "config_info":
-            await query.answer("Показываю информацию о конфиге...")
-            
-            # Проверяем наличие username
-            if not username:
-                await query.edit_message_text(
-                    "❌ У вас не установлен username в настройках Telegram.\n"
-                    "💡 Установите username в настройках Telegram для просмотра информации о конфиге."
-                )
-                return
-            
-            inbound_id = DEFAULT_INBOUND_ID
-            
-            # Получаем все конфиги пользователя
-            user_configs = xui_client.get_user_configs(inbound_id, username)
-            
-            if not user_configs:
-                await query.edit_message_text(
-                    "❌ У вас нет созданных конфигов.\n"
-                    "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
-                )
-                return
-            
-            # Формируем информацию о всех конфигах
-            from datetime import datetime
-            
-            info_text = f"📊 Информация о ваших конфигах:\n\n"
-            info_text += f"📋 Всего конфигов: {len(user_configs)}\n\n"
-            
-            for i, config_data in enumerate(user_configs, 1):
-                email = config_data["email"]
-                client = config_data["client"]
-                traffic = config_data["traffic"]
-                
-                # Получаем данные о трафике
-                total_traffic = traffic.get("allTime", 0)  # в байтах
-                up_traffic = traffic.get("up", 0)  # в байтах
-                down_traffic = traffic.get("down", 0)  # в байтах
-                
-                # Конвертируем в GB
-                total_gb = trafficFormat(total_traffic)
-                up_gb = trafficFormat(up_traffic)
-                down_gb = trafficFormat(down_traffic)
-                
-                # Получаем информацию о сроке действия
-                expire_time = traffic.get("expiryTime", 0)
-                if expire_time > 0:
-                    expire_date = datetime.fromtimestamp(expire_time / 1000)
-                    now = datetime.now()
-                    days_remaining = (expire_date - now).days
-                    expire_str = expire_date.strftime("%Y-%m-%d %H:%M")
-                else:
-                    days_remaining = "∞"
-                    expire_str = "Без ограничений"
+async def _handle_config_info(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              user_id: int, username: Optional[str]):
+    """Кнопка меню: информация о трафике и сроке действия конфигов"""
+    query = update.callback_query
+    
+    # Проверяем наличие username
+    if not username:
+        await query.edit_message_text(
+            "❌ У вас не установлен username в настройках Telegram.\n"
+            "💡 Установите username в настройках Telegram для просмотра информации о конфиге."
+        )
+        return
+    
+    inbound_id = DEFAULT_INBOUND_ID
+    
+    # Получаем все конфиги пользователя
+    user_configs = await asyncio.to_thread(xui_client.get_user_configs, inbound_id, username)
+    
+    if not user_configs:
+        await query.edit_message_text(
+            "❌ У вас нет созданных конфигов.\n"
+            "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
+        )
+        return
+    
+    # Формируем информацию о всех конфигах
+    parts = [f"📊 Информация о ваших конфигах:\n\n📋 Всего конфигов: {len(user_configs)}\n\n"]
+    
+    for i, config_data in enumerate(user_configs, 1):
+        email = config_data["email"]
+        client = config_data["client"]
+        traffic = config_data["traffic"]
+        
+        # Получаем данные о трафике
+        total_traffic = traffic.get("allTime", 0)  # в байтах
+        up_traffic = traffic.get("up", 0)  # в байтах
+        down_traffic = traffic.get("down", 0)  # в байтах
+        
+        # Конвертируем в GB
+        total_gb = trafficFormat(total_traffic)
+        up_gb = trafficFormat(up_traffic)
+        down_gb = trafficFormat(down_traffic)
+        
+        # Получаем информацию о сроке действия
+        expire_time = traffic.get("expiryTime", 0)
+        if expire_time > 0:
+            days_remaining = days_until(expire_time)
+            expire_str = format_timestamp(expire_time)
+        else:
+            days_remaining = "∞"
+            expire_str = "Без ограничений"
 
-                lastOnline = traffic.get("lastOnline", 0)
-                if lastOnline > 0:
-                    last_date = datetime.fromtimestamp(lastOnline / 1000)
-                    last_str = last_date.strftime("%Y-%m-%d %H:%M")
-                else:
-                    last_str = "Нет"
-                
-                info_text += f"━━━━━━━━━━\n"
-                info_text += f"📧 Конфиг #{i}: {email}\n"
-                info_text += f"📈 Трафик: {total_gb} (↑{up_gb} ↓{down_gb})\n"
-                info_text += f"⏰ Осталось дней: {days_remaining}\n"
-                info_text += f"📅 До: {expire_str}\n"
-                info_text += f"⏰ Последний вход: {last_str}\n\n"
-            
-            await query.edit_message_text(info_text)
-            return
-        elif data == "instruction":
-            await query.answer("Показываю инструкцию...")
-            
-            instruction_text = """
+        lastOnline = traffic.get("lastOnline", 0)
+        if lastOnline > 0:
+            last_str = format_timestamp(lastOnline)
+        else:
+            last_str = "Нет"
+        
+        parts.append(CONFIG_INFO_TEMPLATE.format(
+            number=i, email=email, total=total_gb, up=up_gb, down=down_gb,
+            days_remaining=days_remaining, expire=expire_str, last_online=last_str
+        ))
+    
+    await query.edit_message_text("".join(parts))
+
+
+def read_file_bytes(path: str) -> bytes:
+    """Прочитать файл целиком"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def _handle_instruction(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              user_id: int, username: Optional[str]):
+    """Кнопка меню: видео инструкция и ссылки на приложения"""
+    query = update.callback_query
+    
+    instruction_text = """
 📹 Инструкция по использованию бота:
 
 1️⃣ Создание конфига:
@@ -1476,218 +1532,426 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 💡 Для работы с ботом необходим username в Telegram!
 """
-            
-            await query.edit_message_text(instruction_text)
-            
-            # Отправляем видео из файла instruction.mp4
+    
+    await query.edit_message_text(instruction_text)
+    
+    # Отправляем видео из файла instruction.mp4
+    try:
+        # После первой загрузки видео хранится у Telegram: отправляем его по file_id,
+        # не читая файл с диска и не загружая его заново
+        file_id = context.bot_data.get(INSTRUCTION_VIDEO_KEY)
+        video_sent = False
+        if file_id:
             try:
-                # Получаем путь к файлу относительно текущей директории скрипта
-                script_dir = os.path.dirname(os.path.abspath(__file__))
-                video_path = os.path.join(script_dir, "instruction.mp4")
-                
-                if os.path.exists(video_path):
-                    with open(video_path, 'rb') as video_file:
-                        video_msg = await context.bot.send_video(
-                            chat_id=query.message.chat_id,
-                            video=video_file,
-                            caption="📹 Видео инструкция по использованию бота"
-                        )
-                        # Сохраняем message_id для возможного удаления
-                        await save_bot_message_id(context, user_id, video_msg.message_id)
-                    logger.info(f"Видео инструкция отправлена из файла: {video_path}")
-                else:
-                    logger.warning(f"Файл видео инструкции не найден: {video_path}")
-                    # Пытаемся отправить по file_id, если файл не найден
-                    try:
-                        from config import INSTRUCTION_VIDEO_FILE_ID
-                        if INSTRUCTION_VIDEO_FILE_ID:
-                            video_msg = await context.bot.send_video(
-                                chat_id=query.message.chat_id,
-                                video=INSTRUCTION_VIDEO_FILE_ID,
-                                caption="📹 Видео инструкция по использованию бота"
-                            )
-                            # Сохраняем message_id для возможного удаления
-                            await save_bot_message_id(context, user_id, video_msg.message_id)
-                    except ImportError:
-                        pass
-            except Exception as e:
-                logger.error(f"Ошибка при отправке видео инструкции: {e}")
-                # Пытаемся отправить по file_id в случае ошибки
-                try:
-                    from config import INSTRUCTION_VIDEO_FILE_ID
-                    if INSTRUCTION_VIDEO_FILE_ID:
-                        video_msg = await context.bot.send_video(
-                            chat_id=query.message.chat_id,
-                            video=INSTRUCTION_VIDEO_FILE_ID,
-                            caption="📹 Видео инструкция по использованию бота"
-                        )
-                        # Сохраняем message_id для возможного удаления
-                        await save_bot_message_id(context, user_id, video_msg.message_id)
-                except ImportError:
-                    pass
-            
-            # Отправляем ссылки на приложения
-            await send_app_links(context, query.message.chat_id, user_id)
-            
-            return
-        elif data == "config_extend":
-            await query.edit_message_text("Устанавливаю связь с космосом...")
-
-            # Проверяем наличие username
-            if not username:
-                await query.edit_message_text(
-                    "❌ У вас не установлен username в настройках Telegram.\n"
-                    "💡 Установите username в настройках Telegram для получения конфига."
+                video_msg = await context.bot.send_video(
+                    chat_id=query.message.chat_id,
+                    video=file_id,
+                    caption="📹 Видео инструкция по использованию бота"
                 )
-                return
-            
-            inbound_id = DEFAULT_INBOUND_ID
-            
-            # Получаем все конфиги пользователя
-            user_configs = xui_client.get_user_configs(inbound_id, username)
-            
-            if not user_configs:
-                await query.edit_message_text(
-                    "❌ У вас нет созданных конфигов.\n"
-                    "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
+                # Сохраняем message_id для возможного удаления
+                await save_bot_message_id(context, video_msg.message_id)
+                video_sent = True
+            except Exception as e:
+                logger.warning(f"Не удалось отправить видео инструкцию по сохраненному file_id: {e}")
+                context.bot_data.pop(INSTRUCTION_VIDEO_KEY, None)
+        
+        # Получаем путь к файлу относительно текущей директории скрипта
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        video_path = os.path.join(script_dir, "instruction.mp4")
+        
+        if video_sent:
+            logger.info("Видео инструкция отправлена по сохраненному file_id")
+        elif os.path.exists(video_path):
+            # Файл в несколько МБ читаем в отдельном потоке, чтобы не блокировать event loop
+            video_data = await asyncio.to_thread(read_file_bytes, video_path)
+            video_msg = await context.bot.send_video(
+                chat_id=query.message.chat_id,
+                video=video_data,
+                filename=os.path.basename(video_path),
+                caption="📹 Видео инструкция по использованию бота"
+            )
+            # Сохраняем message_id для возможного удаления
+            await save_bot_message_id(context, video_msg.message_id)
+            if video_msg.video:
+                context.bot_data[INSTRUCTION_VIDEO_KEY] = video_msg.video.file_id
+            logger.info(f"Видео инструкция отправлена из файла: {video_path}")
+        else:
+            logger.warning(f"Файл видео инструкции не найден: {video_path}")
+            # Пытаемся отправить по file_id, если файл не найден
+            if INSTRUCTION_VIDEO_FILE_ID:
+                video_msg = await context.bot.send_video(
+                    chat_id=query.message.chat_id,
+                    video=INSTRUCTION_VIDEO_FILE_ID,
+                    caption="📹 Видео инструкция по использованию бота"
                 )
-                return
-            
-            # Получаем протокол из inbound
-            inbounds = xui_client.get_inbounds()
+                # Сохраняем message_id для возможного удаления
+                await save_bot_message_id(context, video_msg.message_id)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке видео инструкции: {e}")
+        # Пытаемся отправить по file_id в случае ошибки
+        if INSTRUCTION_VIDEO_FILE_ID:
+            video_msg = await context.bot.send_video(
+                chat_id=query.message.chat_id,
+                video=INSTRUCTION_VIDEO_FILE_ID,
+                caption="📹 Видео инструкция по использованию бота"
+            )
+            # Сохраняем message_id для возможного удаления
+            await save_bot_message_id(context, video_msg.message_id)
+    
+    # Отправляем ссылки на приложения
+    await send_app_links(context, query.message.chat_id, user_id)
 
-            logger.info(f'Получил inbounds: {inbounds}')
-            inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
-            
-            if not inbound:
-                await query.edit_message_text("❌ Не удалось получить информацию о сервере.")
-                return
+
+async def _handle_config_extend(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                user_id: int, username: Optional[str]):
+    """Кнопка меню: продлить конфиги, срок которых подходит к концу"""
+    query = update.callback_query
+    
+    await query.edit_message_text("Устанавливаю связь с космосом...")
+
+    # Проверяем наличие username
+    if not username:
+        await query.edit_message_text(
+            "❌ У вас не установлен username в настройках Telegram.\n"
+            "💡 Установите username в настройках Telegram для получения конфига."
+        )
+        return
+    
+    inbound_id = DEFAULT_INBOUND_ID
+    
+    # Получаем все конфиги пользователя. Трафик для продления не нужен -
+    # без него это поиск по закешированным клиентам, без HTTP-запроса на каждый конфиг
+    user_configs = await asyncio.to_thread(
+        xui_client.get_user_configs, inbound_id, username, with_traffic=False
+    )
+    
+    if not user_configs:
+        await query.edit_message_text(
+            "❌ У вас нет созданных конфигов.\n"
+            "💡 Используйте кнопку '✨ Создать конфиг' для создания нового конфига."
+        )
+        return
+    
+    # Получаем протокол из inbound
+    inbound = await asyncio.to_thread(xui_client.get_inbound, inbound_id)
+    
+    if not inbound:
+        await query.edit_message_text("❌ Не удалось получить информацию о сервере.")
+        return
+    
+    protocol = inbound.get("protocol", "vless").lower()
+    
+    # Получаем все конфигурации для всех конфигов пользователя
+    parts = [f"📥 Ваши конфигурации ({len(user_configs)} шт.):\n\n"]
+    configs_found = 0
+
+    for i, config_data in enumerate(user_configs, 1):
+        email = config_data["email"]
+        config = await asyncio.to_thread(xui_client.get_client_config, inbound_id, email, protocol)
+        
+        if config:
+            configs_found += 1
+            # Записываем выдачу конфига
+            await asyncio.to_thread(db.record_issued_config, user_id, email, inbound_id)
             
-            protocol = inbound.get("protocol", "vless").lower()
+            # Получаем информацию о клиенте для напоминаний
+            client = config_data["client"]
             
-            # Получаем все конфигурации для всех конфигов пользователя
-            configs_text = f"📥 Ваши конфигурации ({len(user_configs)} шт.):\n\n"
-            configs_found = 0
-
-            from datetime import datetime, timedelta
-
-            for i, config_data in enumerate(user_configs, 1):
-                email = config_data["email"]
-                config = xui_client.get_client_config(inbound_id, email, protocol)
-                
-                if config:
-                    configs_found += 1
-                    # Записываем выдачу конфига
-                    db.record_issued_config(user_id, email, inbound_id)
-                    
-                    # Получаем информацию о клиенте для напоминаний
-                    client = config_data["client"]
-                    
-                    if client and client.get("expiryTime", 0) >= 0:
-                        # проверить сколько дней до просрочки 
-
-                        # Получаем информацию о сроке действия
-                        expire_time = client.get("expiryTime", 0)
-                        if expire_time > 0:
-                            expire_date = datetime.fromtimestamp(expire_time / 1000)
-                            now = datetime.now()
-                            days_remaining = (expire_date - now).days
-                            expire_date_text = expire_date.strftime("%Y-%m-%d %H:%M")
-                            if days_remaining >= 3:
-                                configs_text += f"Конфиг {email} осталось дней: {days_remaining}\n"
-                                configs_text += f"Действует до {expire_date_text}\n"
-                            else:
-
-                                success = xui_client.update_client_expiry(inbound_id, email, CONFIG_EXPIRY_DAYS)
-
-                                if success:
-                                    new_expire_date = datetime.now() + timedelta(days=CONFIG_EXPIRY_DAYS)
-                                    new_expire_time = int(new_expire_date.timestamp() * 1000)
-
-                                    expire_str = new_expire_date.strftime("%Y-%m-%d %H:%M")
-
-                                    configs_text += f"Конфиг {email} продлен до {expire_str}\n"
-                                else:
-                                    configs_text += f"Не удалось продлить конфиг {email}\n"
+            if client and client.get("expiryTime", 0) >= 0:
+                # проверить сколько дней до просрочки 
+
+                # Получаем информацию о сроке действия
+                expire_time = client.get("expiryTime", 0)
+                if expire_time > 0:
+                    days_remaining = days_until(expire_time)
+                    expire_date_text = format_timestamp(expire_time)
+                    if days_remaining >= 3:
+                        parts.append(f"Конфиг {email} осталось дней: {days_remaining}\n")
+                        parts.append(f"Действует до {expire_date_text}\n")
+                    else:
+
+                        new_expiry = await asyncio.to_thread(xui_client.update_client_expiry, inbound_id, email, CONFIG_EXPIRY_DAYS)
+
+                        if new_expiry:
+                            expire_str = format_timestamp(new_expiry)
+
+                            parts.append(f"Конфиг {email} продлен до {expire_str}\n")
                         else:
-                            configs_text += f"Конфиг {email} без ограничений\n"
+                            parts.append(f"Не удалось продлить конфиг {email}\n")
+                else:
+                    parts.append(f"Конфиг {email} без ограничений\n")
 
-            await query.edit_message_text(configs_text)
-                    
-            if configs_found == 0:
-                await query.edit_message_text(
-                    "❌ Не удалось получить конфигурации."
-                )
-            return
-        elif data == "contact_admin":
-            await query.answer("Открываю контакты администратора...")
+    await query.edit_message_text("".join(parts))
+            
+    if configs_found == 0:
+        await query.edit_message_text(
+            "❌ Не удалось получить конфигурации."
+        )
 
-            admin_list = ', '.join(['@'+u.lstrip('@').lower() for u in ADMIN_USERNAMES])
 
-            admin_text = """
-💬 Связь с администратором:
+async def _handle_contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                user_id: int, username: Optional[str]):
+    """Кнопка меню: контакты администратора"""
+    query = update.callback_query
+    
+    admin_text = CONTACT_ADMIN_PREFIX + (username or "не указан") + CONTACT_ADMIN_SUFFIX
+    
+    await query.edit_message_text(admin_text)
 
-👤 Администратор:
-• {admin_list}
 
-📝 Для связи с администратором:
-1. Напишите администратору в Telegram
-2. Укажите ваш username: @{username}
-3. Опишите вашу проблему или вопрос
+# Обработчики inline кнопок меню по значению callback_data
+BUTTON_HANDLERS = {
+    "create_config": _handle_create_config,
+    "download_config": _handle_download_config,
+    "config_info": _handle_config_info,
+    "instruction": _handle_instruction,
+    "config_extend": _handle_config_extend,
+    "contact_admin": _handle_contact_admin,
+}
 
-💡 Администратор может помочь с:
-• Увеличением лимита конфигов
-• Решением технических проблем
-• Вопросами по использованию бота
-""".format(username=username or "не указан", admin_list=admin_list)
-            
-            await query.edit_message_text(admin_text)
-            return
 
-                
+@require_access
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий на inline кнопки"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    username = query.from_user.username
+    
+    await query.answer()
+    
+    data = query.data
+    
+    #logger.info(f'button_callback: {data}')
+
+    try:
+        handler = BUTTON_HANDLERS.get(data)
+        if handler is not None:
+            await handler(update, context, user_id, username)
+
     except Exception as e:
         logger.error(f"Ошибка в button_callback: {e}")
         await query.edit_message_text(f"❌ Ошибка: {str(e)}")
 
 
+# ========== ОТЛОЖЕННАЯ ЗАПИСЬ ВЫДАННЫХ КОНФИГОВ ==========
+
+# Записи (user_id, email, inbound_id, expire_time) копятся в очереди и пишутся в базу пачками
+ISSUED_CONFIGS_BATCH_SIZE = 64
+ISSUED_CONFIGS_FLUSH_DELAY = 0.1  # секунды ожидания следующих записей для пачки
+ISSUED_CONFIGS_WRITE_ATTEMPTS = 3  # попытки записать пачку целиком
+ISSUED_CONFIGS_RETRY_DELAY = 1  # секунды между попытками
+
+issued_configs_queue: Optional[asyncio.Queue] = None
+issued_configs_writer_task: Optional[asyncio.Task] = None
+
+
+async def record_issued_config_later(user_id: int, email: str, inbound_id: int, expire_time: Optional[int]):
+    """Поставить запись выданного конфига и напоминания в очередь на запись в базу"""
+    item = (user_id, email, inbound_id, expire_time)
+    if issued_configs_queue is None:
+        # Фоновая запись не запущена - пишем сразу, но не в потоке event loop
+        await asyncio.to_thread(db.record_configs_and_reminders, [item])
+        return
+    issued_configs_queue.put_nowait(item)
+
+
+async def _issued_configs_writer(queue: asyncio.Queue):
+    """Фоновая задача: записывает накопленные выданные конфиги одной транзакцией на пачку
+    
+    Пачки пишутся по порядку; следующая собирается только после записи предыдущей.
+    Завершается, получив из очереди None (см. stop_issued_configs_writer),
+    предварительно записав уже собранную пачку.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = loop.time() + ISSUED_CONFIGS_FLUSH_DELAY
+        while len(batch) < ISSUED_CONFIGS_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        
+        await _write_issued_configs(batch)
+
+
+async def _write_issued_configs(batch: list):
+    """Записать пачку выданных конфигов, повторяя запись при ошибках
+    
+    Если пачка не записывается за ISSUED_CONFIGS_WRITE_ATTEMPTS попыток, записи пишутся
+    по одной: запись, которая не проходит (например, из-за ограничения в базе),
+    логируется и отбрасывается, не задерживая остальные.
+    """
+    for attempt in range(ISSUED_CONFIGS_WRITE_ATTEMPTS):
+        if await asyncio.to_thread(db.record_configs_and_reminders, batch):
+            return
+        logger.error(f"Не удалось записать {len(batch)} выданных конфигов "
+                     f"(попытка {attempt + 1}/{ISSUED_CONFIGS_WRITE_ATTEMPTS})")
+        if attempt + 1 < ISSUED_CONFIGS_WRITE_ATTEMPTS:
+            await asyncio.sleep(ISSUED_CONFIGS_RETRY_DELAY)
+    
+    for item in batch:
+        if len(batch) == 1 or not await asyncio.to_thread(db.record_configs_and_reminders, [item]):
+            logger.error(f"Запись выданного конфига отброшена после повторных ошибок: {item}")
+
+
+def start_issued_configs_writer():
+    """Запустить фоновую запись выданных конфигов"""
+    global issued_configs_queue, issued_configs_writer_task
+    issued_configs_queue = asyncio.Queue()
+    issued_configs_writer_task = asyncio.create_task(_issued_configs_writer(issued_configs_queue))
+
+
+async def stop_issued_configs_writer():
+    """Остановить фоновую запись и записать все, что осталось в очереди"""
+    global issued_configs_queue, issued_configs_writer_task
+    if issued_configs_writer_task is None:
+        return
+    
+    # Не отменяем задачу (собранная ею пачка потерялась бы), а просим ее завершиться
+    issued_configs_queue.put_nowait(None)
+    await issued_configs_writer_task
+    
+    remaining = []
+    while not issued_configs_queue.empty():
+        item = issued_configs_queue.get_nowait()
+        if item is not None:
+            remaining.append(item)
+    issued_configs_queue = None
+    issued_configs_writer_task = None
+    
+    if remaining:
+        await _write_issued_configs(remaining)
+
+
 # ========== СИСТЕМА НАПОМИНАНИЙ ==========
 
-async def check_and_send_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Проверка и отправка напоминаний"""
-    try:
-        for days in REMINDER_DAYS:
-            reminders = db.get_pending_reminders(days)
-            
-            for reminder in reminders:
-                user_id = reminder.get("user_id")
-                email = reminder.get("email")
-                expire_time = reminder.get("expire_time")
-                reminder_id = reminder.get("id")
-                
-                expire_date = datetime.fromtimestamp(expire_time / 1000)
-                
-                message = f"""
+# Не больше 30 одновременных отправок: глобальный лимит Telegram ~30 сообщений в секунду
+REMINDER_SEND_CONCURRENCY = 30
+
+# Попытки отметить доставленное напоминание отправленным (ошибка - например, занятая база)
+REMINDER_MARK_ATTEMPTS = 3
+REMINDER_MARK_RETRY_DELAY = 0.5  # секунды
+
+# Пока напоминаний нет, интервал проверки растет в REMINDER_CHECK_BACKOFF раз
+# от REMINDER_CHECK_INTERVAL до REMINDER_CHECK_MAX_INTERVAL. Окно отправки напоминания
+# длится 2 дня, поэтому и при максимальном интервале напоминание не пропускается
+REMINDER_CHECK_BACKOFF = 1.5
+REMINDER_CHECK_MAX_INTERVAL = max(6 * 60 * 60, REMINDER_CHECK_INTERVAL)
+# Не проверяем чаще, чем раз в минуту, даже если окно ближайшего напоминания вот-вот начнется
+REMINDER_CHECK_MIN_DELAY = 60
+# Ключ bot_data с текущим интервалом проверки
+REMINDER_INTERVAL_KEY = "reminder_check_interval"
+
+REMINDER_TEMPLATE = """
 ⏰ Напоминание о истечении VPN конфигурации
 
 📧 Email: {email}
 📅 Истекает через: {days} дней
-🗓️ Дата истечения: {expire_date.strftime('%Y-%m-%d %H:%M')}
+🗓️ Дата истечения: {expire_date}
 
 💡 Не забудьте продлить или создать новый конфиг!
 """
-                
-                try:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=message
-                    )
-                    db.mark_reminder_sent(reminder_id, days)
-                    logger.info(f"Напоминание отправлено пользователю {user_id} для {email} за {days} дней")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки напоминания: {e}")
-                    
+
+
+async def _send_reminder(context: ContextTypes.DEFAULT_TYPE, semaphore: asyncio.Semaphore,
+                         reminder: dict, days: int) -> bool:
+    """Отправить одно напоминание и сразу отметить его отправленным
+    
+    Returns:
+        True, если сообщение доставлено
+    """
+    user_id = reminder.get("user_id")
+    email = reminder.get("email")
+    expire_time = reminder.get("expire_time")
+    reminder_id = reminder.get("id")
+    
+    message = REMINDER_TEMPLATE.format(
+        email=email, days=days, expire_date=reminder.get("expire_date") or format_timestamp(expire_time)
+    )
+    
+    async with semaphore:
+        try:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=message
+            )
+            logger.info(f"Напоминание {reminder_id} отправлено пользователю {user_id} для {email} за {days} дней")
+        except Exception as e:
+            logger.error(f"Ошибка отправки напоминания: {e}")
+            return False
+    
+    # Отмечаем сразу после доставки, не дожидаясь остальных отправок: неотмеченное
+    # напоминание следующая проверка отправила бы повторно
+    for attempt in range(REMINDER_MARK_ATTEMPTS):
+        if await asyncio.to_thread(db.mark_reminder_sent, reminder_id, days):
+            break
+        if attempt + 1 < REMINDER_MARK_ATTEMPTS:
+            await asyncio.sleep(REMINDER_MARK_RETRY_DELAY)
+    else:
+        logger.error(f"Напоминание {reminder_id} отправлено, но не отмечено - возможна повторная отправка")
+    return True
+
+
+async def check_and_send_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Проверка и отправка напоминаний
+    
+    Задача сама планирует следующий запуск: после пустой проверки интервал растет,
+    после отправки напоминаний возвращается к REMINDER_CHECK_INTERVAL.
+    """
+    sent = []
+    try:
+        semaphore = asyncio.Semaphore(REMINDER_SEND_CONCURRENCY)
+        # Напоминания для всех порогов REMINDER_DAYS получаем одним запросом
+        pending = await asyncio.to_thread(db.get_pending_reminders_multi, REMINDER_DAYS)
+        tasks = [_send_reminder(context, semaphore, reminder, days) for reminder, days in pending]
+        
+        # Напоминания отправляются параллельно, а не по одному.
+        # Каждое отмечается отправленным сразу после своей доставки
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        sent = [result for result in results if result is True]
+        
     except Exception as e:
         logger.error(f"Ошибка в check_and_send_reminders: {e}")
+    finally:
+        # Интервал сбрасываем, только если что-то действительно отправлено: напоминание,
+        # которое не доставляется (бот заблокирован), не должно отменять рост интервала
+        await schedule_reminders_check(context, bool(sent))
+
+
+async def schedule_reminders_check(context: ContextTypes.DEFAULT_TYPE, sent: bool):
+    """Запланировать следующую проверку напоминаний"""
+    if sent:
+        interval = REMINDER_CHECK_INTERVAL
+    else:
+        interval = min(
+            context.bot_data.get(REMINDER_INTERVAL_KEY, REMINDER_CHECK_INTERVAL) * REMINDER_CHECK_BACKOFF,
+            REMINDER_CHECK_MAX_INTERVAL
+        )
+    context.bot_data[REMINDER_INTERVAL_KEY] = interval
+    
+    # Если окно ближайшего известного напоминания начнется раньше - проверяем к его началу
+    delay = interval
+    try:
+        next_due = await asyncio.to_thread(db.get_next_reminder_due, REMINDER_DAYS)
+        if next_due is not None:
+            until_due = (next_due - int(time.time() * 1000)) / 1000
+            delay = max(REMINDER_CHECK_MIN_DELAY, min(delay, until_due))
+    except Exception as e:
+        logger.error(f"Ошибка получения ближайшего напоминания: {e}")
+    
+    context.job_queue.run_once(check_and_send_reminders, when=delay)
 
 
 def main():
@@ -1696,7 +1960,26 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN не установлен! Установите его в переменных окружения или config.py")
         return
     
+    # Используем uvloop в качестве event loop, если он установлен (на Windows недоступен)
+    try:
+        import uvloop
+        # uvloop.install() устарел в новых версиях uvloop, политику задаем напрямую
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("uvloop установлен в качестве event loop")
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный event loop asyncio")
+    
     # Создаем приложение
+    async def post_init(app: Application):
+        """Инициализация после запуска приложения"""
+        await set_bot_description(app)
+        start_issued_configs_writer()
+    
+    async def post_shutdown(app: Application):
+        """Завершение работы: дописываем в базу отложенные записи и закрываем соединения к x-ui"""
+        await stop_issued_configs_writer()
+        xui_client.close()
+    
     async def set_bot_description(app: Application):
         """Установить описание бота при инициализации"""
         try:
@@ -1707,7 +1990,38 @@ def main():
         except Exception as e:
             logger.error(f"Ошибка при установке описания бота: {e}")
     
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(set_bot_description).build()
+    # concurrent_updates: обновления разных пользователей обрабатываются параллельно,
+    # медленный запрос к x-ui одного пользователя не блокирует остальных
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(True)
+        # Обработчики не блокируют друг друга и не ждут завершения предыдущего
+        .defaults(Defaults(block=False))
+        # Пул соединений к Bot API рассчитан на параллельные обработчики,
+        # каждый из которых отправляет несколько сообщений подряд
+        .connection_pool_size(256)
+        .pool_timeout(20)
+        .read_timeout(20)
+        .write_timeout(20)
+        .connect_timeout(10)
+        # Отдельный небольшой пул для long polling getUpdates
+        .get_updates_connection_pool_size(2)
+        .get_updates_pool_timeout(20)
+        # Исходящие запросы к Bot API идут через ограничитель скорости:
+        # не более 30 сообщений в секунду в целом и 20 в минуту на группу.
+        # При RetryAfter запрос повторяется после паузы, а не падает
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=3
+        ))
+        .build()
+    )
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
@@ -1737,10 +2051,10 @@ def main():
     # Настраиваем периодическую проверку напоминаний (если JobQueue доступен)
     job_queue = application.job_queue
     if job_queue is not None:
-        job_queue.run_repeating(
+        # Следующие проверки задача планирует сама (см. schedule_reminders_check)
+        job_queue.run_once(
             check_and_send_reminders,
-            interval=REMINDER_CHECK_INTERVAL,
-            first=10  # Первая проверка через 10 секунд после запуска
+            when=10  # Первая проверка через 10 секунд после запуска
         )
         logger.info("Система напоминаний активирована")
     else:
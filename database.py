@@ -3,102 +3,188 @@
 """
 import sqlite3
 import logging
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
 from typing import Optional, Dict, List, Tuple
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Сколько секунд помнить соответствие username -> user_id
+USERNAME_CACHE_TTL = 60
+
+# Сколько секунд строка пользователя из get_user считается актуальной.
+# Все изменения таблицы users сбрасывают кеш сразу после commit
+USER_CACHE_TTL = 10
+
+# Допустимое имя таблицы для подстановки в SQL
+TABLE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
 
 class Database:
     """Класс для работы с базой данных SQLite"""
     
-    def __init__(self, db_path: str = "bot.db"):
+    def __init__(self, db_path: str = "bot.db", pool_size: int = 8):
         self.db_path = db_path
+        # Пул открытых соединений: переиспользуем их вместо connect/close на каждый запрос.
+        # LIFO отдает последнее возвращенное соединение - с самым "теплым" кешем страниц
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=pool_size)
+        # username -> (user_id, время записи). Кешируем только user_id: сама строка
+        # читается по первичному ключу, поэтому лимиты и счетчики всегда актуальны
+        self._user_id_by_name: Dict[str, Tuple[int, float]] = {}
+        self._user_id_by_name_lock = threading.Lock()
+        # user_id -> (строка users или None, время чтения)
+        self._user_cache: Dict[int, Tuple[Optional[Dict], float]] = {}
+        # Растет при каждом сбросе кеша: чтение, начатое до изменения, не попадет в кеш
+        self._user_cache_epoch = 0
+        self._user_cache_lock = threading.Lock()
         self.init_database()
     
     def get_connection(self):
-        """Получить соединение с базой данных"""
-        conn = sqlite3.connect(self.db_path)
+        """Открыть новое соединение с базой данных"""
+        # Соединения из пула используются из рабочих потоков (asyncio.to_thread),
+        # но одновременно только одним потоком
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        # WAL позволяет читать параллельно с записью, NORMAL убирает fsync на каждый commit
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # Кеш страниц соединения ~20 МБ (отрицательное значение - в килобайтах)
+        conn.execute("PRAGMA cache_size=-20000")
+        # Чтение через отображение файла в память (до 256 МБ) вместо системных вызовов read
+        conn.execute("PRAGMA mmap_size=268435456")
         return conn
     
+    @contextmanager
+    def _acquire(self):
+        """Взять соединение из пула и вернуть его обратно после использования"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self.get_connection()
+        
+        try:
+            yield conn
+        finally:
+            # Незавершенная транзакция не должна попасть в следующий запрос
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
     def init_database(self):
         """Инициализация базы данных"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._acquire() as conn:
+            cursor = conn.cursor()
 
-        # Таблица доступа к боту
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS alloved_users (
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+            # Таблица доступа к боту
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS alloved_users (
+                    username TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
         
-        # Таблица пользователей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                config_limit INTEGER DEFAULT 0,
-                configs_created INTEGER DEFAULT 0,
-                is_admin INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+            # Таблица пользователей
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    full_name TEXT,
+                    config_limit INTEGER DEFAULT 0,
+                    configs_created INTEGER DEFAULT 0,
+                    is_admin INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
         
-        # Таблица выданных конфигов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS issued_configs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                email TEXT,
-                inbound_id INTEGER,
-                issued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
+            # Таблица выданных конфигов
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS issued_configs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    email TEXT,
+                    inbound_id INTEGER,
+                    issued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            """)
         
-        # Таблица напоминаний
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS reminders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                email TEXT,
-                inbound_id INTEGER,
-                expire_time INTEGER,
-                reminder_10_days_sent INTEGER DEFAULT 0,
-                reminder_3_days_sent INTEGER DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-        """)
+            # Таблица напоминаний
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS reminders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    email TEXT,
+                    inbound_id INTEGER,
+                    expire_time INTEGER,
+                    reminder_10_days_sent INTEGER DEFAULT 0,
+                    reminder_3_days_sent INTEGER DEFAULT 0,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+            """)
+            
+            # Индексы для выборки неотправленных напоминаний по окну expire_time
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_reminders_pending_10
+                ON reminders (reminder_10_days_sent, expire_time)
+            """)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_reminders_pending_3
+                ON reminders (reminder_3_days_sent, expire_time)
+            """)
+            
+            # Индексы для точечных поисков вместо полного просмотра таблиц
+            # Замена напоминания конфига: DELETE ... WHERE user_id = ? AND email = ? AND inbound_id = ?
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_reminders_lookup
+                ON reminders (user_id, email, inbound_id)
+            """)
+            # Конфиги пользователя: WHERE user_id = ?
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_issued_configs_lookup
+                ON issued_configs (user_id, email, inbound_id)
+            """)
+            # Поиск пользователя по username: индекс по тому же выражению, что в get_user_by_username
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_username
+                ON users (LOWER(REPLACE(username, '@', '')))
+            """)
+            # Проверка доступа: WHERE username = ?
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_alloved_users_username
+                ON alloved_users (username)
+            """)
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         logger.info("База данных инициализирована")
 
     def add_allowed_user(self, username):
         """Открыть доступ пользователя в боту"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
 
-            # Проверяем, существует ли пользователь
-            cursor.execute("SELECT * FROM alloved_users WHERE username = ?", (username,))
-            existing = cursor.fetchone()
+                # Проверяем, существует ли пользователь
+                cursor.execute("SELECT * FROM alloved_users WHERE username = ?", (username,))
+                existing = cursor.fetchone()
 
-            if existing:
-                logger.info(f"У юзера {username} есть доступ к боту")
-            else:
-                cursor.execute("""
-                    INSERT INTO alloved_users (username)
-                    VALUES (?)
-                """, (username,))
-                logger.info(f"Юзеру {username} открыт доступ к боту")
+                if existing:
+                    logger.info(f"У юзера {username} есть доступ к боту")
+                else:
+                    cursor.execute("""
+                        INSERT INTO alloved_users (username)
+                        VALUES (?)
+                    """, (username,))
+                    logger.info(f"Юзеру {username} открыт доступ к боту")
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             return True
 
         except Exception as e:
@@ -109,21 +195,20 @@ class Database:
         """Проерка юреза доступа к боту"""
         try:
             result = False
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
 
-            # Проверяем, существует ли пользователь
-            cursor.execute("SELECT * FROM alloved_users WHERE username = ?", (username,))
-            existing = cursor.fetchone()
+                # Проверяем, существует ли пользователь
+                cursor.execute("SELECT * FROM alloved_users WHERE username = ?", (username,))
+                existing = cursor.fetchone()
 
-            if existing:
-                logger.info(f"У юзера {username} есть доступ к боту")
-                result = True
-            else:
-                logger.info(f"Юзеру {username} открыт доступ к боту")
+                if existing:
+                    logger.info(f"У юзера {username} есть доступ к боту")
+                    result = True
+                else:
+                    logger.info(f"Юзеру {username} открыт доступ к боту")
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             return result
 
         except Exception as e:
@@ -134,72 +219,135 @@ class Database:
                  full_name: Optional[str] = None, config_limit: int = 1) -> bool:
         """Добавить пользователя или обновить его данные"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Проверяем, существует ли пользователь
-            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            existing = cursor.fetchone()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            if existing:
-                # Обновляем только username и full_name, сохраняя лимит
-                cursor.execute("""
-                    UPDATE users SET username = ?, full_name = ?
-                    WHERE user_id = ?
-                """, (username, full_name, user_id))
-                logger.info(f"Данные пользователя {user_id} обновлены")
-            else:
-                # Создаем нового пользователя с лимитом по умолчанию 1
+                # Новый пользователь получает лимит по умолчанию 1, у существующего
+                # обновляем только username и full_name, сохраняя лимит
                 if config_limit == 0:
                     config_limit = 1
                 cursor.execute("""
                     INSERT INTO users (user_id, username, full_name, config_limit)
                     VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username, full_name = excluded.full_name
                 """, (user_id, username, full_name, config_limit))
-                logger.info(f"Пользователь {user_id} добавлен с лимитом {config_limit}")
+                logger.info(f"Пользователь {user_id} добавлен или обновлен")
             
-            conn.commit()
-            conn.close()
+                conn.commit()
+            self._invalidate_users([user_id])
             return True
         except Exception as e:
             logger.error(f"Ошибка добавления пользователя: {e}")
             return False
     
-    def get_user(self, user_id: int) -> Optional[Dict]:
-        """Получить информацию о пользователе"""
+    def get_or_create_user(self, user_id: int, username: Optional[str] = None,
+                           full_name: Optional[str] = None, config_limit: int = 1) -> Optional[Dict]:
+        """Получить пользователя, создав его при первом обращении"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
+            
+                # Создаем нового пользователя с лимитом по умолчанию 1
+                if config_limit == 0:
+                    config_limit = 1
+                cursor.execute("""
+                    INSERT OR IGNORE INTO users (user_id, username, full_name, config_limit)
+                    VALUES (?, ?, ?, ?)
+                """, (user_id, username, full_name, config_limit))
+                created = cursor.rowcount
+                if created:
+                    logger.info(f"Пользователь {user_id} добавлен с лимитом {config_limit}")
             
-            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            row = cursor.fetchone()
-            conn.close()
+                cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+            
+                conn.commit()
+            if created:
+                self._invalidate_users([user_id])
             
             if row:
                 return dict(row)
             return None
+        except Exception as e:
+            logger.error(f"Ошибка получения или создания пользователя: {e}")
+            return None
+    
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """Получить информацию о пользователе"""
+        user = self._get_user_row(user_id)
+        return dict(user) if user else None
+    
+    def _get_user_row(self, user_id: int) -> Optional[Dict]:
+        """Строка пользователя из кеша (или из базы) без копирования
+        
+        Возвращается общий для всех вызовов словарь - изменять его нельзя.
+        Для проверок только на чтение (лимиты, статус администратора).
+        """
+        with self._user_cache_lock:
+            cached = self._user_cache.get(user_id)
+            epoch = self._user_cache_epoch
+        if cached and time.monotonic() - cached[1] < USER_CACHE_TTL:
+            return cached[0]
+        
+        try:
+            with self._acquire() as conn:
+                cursor = conn.cursor()
+            
+                cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+            
+            user = dict(row) if row else None
+            with self._user_cache_lock:
+                if epoch == self._user_cache_epoch:
+                    self._user_cache[user_id] = (user, time.monotonic())
+            return user
         except Exception as e:
             logger.error(f"Ошибка получения пользователя: {e}")
             return None
     
+    def _invalidate_users(self, user_ids=None):
+        """Сбросить кеш get_user для указанных пользователей (или для всех)"""
+        with self._user_cache_lock:
+            if user_ids is None:
+                self._user_cache.clear()
+            else:
+                for user_id in user_ids:
+                    self._user_cache.pop(user_id, None)
+            self._user_cache_epoch += 1
+    
     def get_user_by_username(self, username: str) -> Optional[Dict]:
         """Получить пользователя по username"""
+        # Нормализуем username (убираем @ и приводим к нижнему регистру)
+        normalized_username = username.lstrip('@').lower()
+        
+        # Поиск по username — полный просмотр таблицы, поиск по user_id — по первичному ключу.
+        # Если user_id уже известен и username у него не изменился, обходимся вторым
+        with self._user_id_by_name_lock:
+            cached = self._user_id_by_name.get(normalized_username)
+        if cached and time.monotonic() - cached[1] < USERNAME_CACHE_TTL:
+            user = self.get_user(cached[0])
+            if user and (user.get("username") or "").lstrip('@').lower() == normalized_username:
+                return user
+        
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            # Нормализуем username (убираем @ и приводим к нижнему регистру)
-            normalized_username = username.lstrip('@').lower()
+                # Ищем пользователя с учетом нормализации
+                # Проверяем оба варианта: с @ и без, в разном регистре
+                # Используем REPLACE для удаления @ и LOWER для приведения к нижнему регистру
+                cursor.execute("""
+                    SELECT * FROM users 
+                    WHERE LOWER(REPLACE(username, '@', '')) = ?
+                """, (normalized_username,))
+                row = cursor.fetchone()
             
-            # Ищем пользователя с учетом нормализации
-            # Проверяем оба варианта: с @ и без, в разном регистре
-            # Используем REPLACE для удаления @ и LOWER для приведения к нижнему регистру
-            cursor.execute("""
-                SELECT * FROM users 
-                WHERE LOWER(REPLACE(username, '@', '')) = ?
-            """, (normalized_username,))
-            row = cursor.fetchone()
-            conn.close()
+            with self._user_id_by_name_lock:
+                if row:
+                    self._user_id_by_name[normalized_username] = (row["user_id"], time.monotonic())
+                else:
+                    self._user_id_by_name.pop(normalized_username, None)
             
             if row:
                 return dict(row)
@@ -208,69 +356,35 @@ class Database:
             logger.error(f"Ошибка получения пользователя по username: {e}")
             return None
     
+    def invalidate_username_cache(self, username: Optional[str] = None):
+        """Забыть закешированный user_id для username (или для всех, если username не указан)"""
+        with self._user_id_by_name_lock:
+            if username is None:
+                self._user_id_by_name.clear()
+            else:
+                self._user_id_by_name.pop(username.lstrip('@').lower(), None)
+    
     def set_config_limit(self, user_id: int, limit: int) -> bool:
         """Установить лимит конфигов для пользователя"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute("""
-                UPDATE users SET config_limit = ? WHERE user_id = ?
-            """, (limit, user_id))
+                cursor.execute("""
+                    UPDATE users SET config_limit = ? WHERE user_id = ?
+                """, (limit, user_id))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
+            self._invalidate_users([user_id])
             logger.info(f"Лимит для пользователя {user_id} установлен: {limit}")
             return True
         except Exception as e:
             logger.error(f"Ошибка установки лимита: {e}")
             return False
     
-    def increment_configs_created(self, user_id: int, conn=None) -> bool:
-        """Увеличить счетчик созданных конфигов"""
-        try:
-            # Если передано соединение, используем его, иначе создаем новое
-            should_close = False
-            if conn is None:
-                conn = self.get_connection()
-                should_close = True
-            
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                UPDATE users SET configs_created = configs_created + 1 
-                WHERE user_id = ?
-            """, (user_id,))
-            
-            if should_close:
-                conn.commit()
-                conn.close()
-            return True
-        except sqlite3.OperationalError as e:
-            if "locked" in str(e).lower():
-                # Если база заблокирована, пробуем еще раз с небольшой задержкой
-                import time
-                time.sleep(0.1)
-                if conn is None:
-                    conn = self.get_connection()
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE users SET configs_created = configs_created + 1 
-                    WHERE user_id = ?
-                """, (user_id,))
-                if should_close or conn is None:
-                    conn.commit()
-                    conn.close()
-                return True
-            logger.error(f"Ошибка увеличения счетчика: {e}")
-            return False
-        except Exception as e:
-            logger.error(f"Ошибка увеличения счетчика: {e}")
-            return False
-    
     def can_create_config(self, user_id: int):
         """Проверить, может ли пользователь создать конфиг"""
-        user = self.get_user(user_id)
+        user = self._get_user_row(user_id)
         
         if not user:
             return False, "Пользователь не найден в базе. Обратитесь к администратору."
@@ -289,18 +403,17 @@ class Database:
     def get_user_configs(self, user_id: int) -> List[Dict]:
         """Получить все конфиги пользователя"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute("""
-                SELECT email, inbound_id, issued_at 
-                FROM issued_configs 
-                WHERE user_id = ?
-                ORDER BY issued_at DESC
-            """, (user_id,))
+                cursor.execute("""
+                    SELECT email, inbound_id, issued_at 
+                    FROM issued_configs 
+                    WHERE user_id = ?
+                    ORDER BY issued_at DESC
+                """, (user_id,))
             
-            rows = cursor.fetchall()
-            conn.close()
+                rows = cursor.fetchall()
             
             configs = []
             for row in rows:
@@ -318,35 +431,25 @@ class Database:
     def record_issued_config(self, user_id: int, email: str, inbound_id: int) -> bool:
         """Записать выданный конфиг"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO issued_configs (user_id, email, inbound_id)
-                VALUES (?, ?, ?)
-            """, (user_id, email, inbound_id))
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            # Используем то же соединение для увеличения счетчика
-            self.increment_configs_created(user_id, conn)
+                # Запись и увеличение счетчика - одной транзакцией на одном соединении
+                self._record_issue(cursor, user_id, email, inbound_id, None)
             
-            conn.commit()
-            conn.close()
+                conn.commit()
+            self._invalidate_users([user_id])
             return True
         except sqlite3.OperationalError as e:
             if "locked" in str(e).lower():
                 # Если база заблокирована, пробуем еще раз с небольшой задержкой
-                import time
                 time.sleep(0.2)
                 try:
-                    conn = self.get_connection()
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO issued_configs (user_id, email, inbound_id)
-                        VALUES (?, ?, ?)
-                    """, (user_id, email, inbound_id))
-                    self.increment_configs_created(user_id, conn)
-                    conn.commit()
-                    conn.close()
+                    with self._acquire() as conn:
+                        cursor = conn.cursor()
+                        self._record_issue(cursor, user_id, email, inbound_id, None)
+                        conn.commit()
+                    self._invalidate_users([user_id])
                     return True
                 except Exception as retry_e:
                     logger.error(f"Ошибка записи конфига при повторной попытке: {retry_e}")
@@ -357,18 +460,91 @@ class Database:
             logger.error(f"Ошибка записи конфига: {e}")
             return False
     
+    def _record_issue(self, cursor, user_id: int, email: str, inbound_id: int,
+                      expire_time: Optional[int]):
+        """Записать выданный конфиг, увеличить счетчик и заменить напоминание
+        
+        Выполняется внутри транзакции вызывающего кода, commit делает он.
+        """
+        cursor.execute("""
+            INSERT INTO issued_configs (user_id, email, inbound_id)
+            VALUES (?, ?, ?)
+        """, (user_id, email, inbound_id))
+        cursor.execute("""
+            UPDATE users SET configs_created = configs_created + 1 
+            WHERE user_id = ?
+        """, (user_id,))
+        
+        if expire_time and expire_time > 0:
+            cursor.execute("""
+                DELETE FROM reminders 
+                WHERE user_id = ? AND email = ? AND inbound_id = ?
+            """, (user_id, email, inbound_id))
+            cursor.execute("""
+                INSERT INTO reminders (user_id, email, inbound_id, expire_time)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, email, inbound_id, expire_time))
+    
+    def record_configs_and_reminders(self, items: List[Tuple[int, str, int, Optional[int]]]) -> bool:
+        """Записать пачку выданных конфигов и напоминаний одной транзакцией
+        
+        Args:
+            items: Список (user_id, email, inbound_id, expire_time)
+        """
+        if not items:
+            return True
+        try:
+            with self._acquire() as conn:
+                cursor = conn.cursor()
+                
+                for user_id, email, inbound_id, expire_time in items:
+                    self._record_issue(cursor, user_id, email, inbound_id, expire_time)
+                
+                conn.commit()
+            self._invalidate_users({item[0] for item in items})
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи конфигов: {e}")
+            return False
+    
+    def finalize_issue(self, user_id: int, email: str, inbound_id: int,
+                       expire_time: Optional[int] = None) -> Optional[Dict]:
+        """Записать выданный конфиг и напоминание и вернуть обновленного пользователя
+        
+        Запись, увеличение счетчика, напоминание и чтение пользователя
+        выполняются одной транзакцией на одном соединении.
+        
+        Returns:
+            Словарь пользователя с обновленным configs_created или None при ошибке
+        """
+        try:
+            with self._acquire() as conn:
+                cursor = conn.cursor()
+                
+                self._record_issue(cursor, user_id, email, inbound_id, expire_time)
+                
+                cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+                
+                conn.commit()
+            self._invalidate_users([user_id])
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка записи выданного конфига: {e}")
+            return None
+    
     def set_admin(self, user_id: int, is_admin: bool = True) -> bool:
         """Установить статус администратора"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute("""
-                UPDATE users SET is_admin = ? WHERE user_id = ?
-            """, (1 if is_admin else 0, user_id))
+                cursor.execute("""
+                    UPDATE users SET is_admin = ? WHERE user_id = ?
+                """, (1 if is_admin else 0, user_id))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
+            self._invalidate_users([user_id])
             logger.info(f"Статус администратора для {user_id}: {is_admin}")
             return True
         except Exception as e:
@@ -377,7 +553,7 @@ class Database:
     
     def is_admin(self, user_id: int) -> bool:
         """Проверить, является ли пользователь администратором"""
-        user = self.get_user(user_id)
+        user = self._get_user_row(user_id)
         if user:
             return bool(user.get("is_admin", 0))
         return False
@@ -385,12 +561,11 @@ class Database:
     def get_all_users(self) -> List[Dict]:
         """Получить список всех пользователей"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute("SELECT * FROM users ORDER BY created_at DESC")
-            rows = cursor.fetchall()
-            conn.close()
+                cursor.execute("SELECT * FROM users ORDER BY created_at DESC")
+                rows = cursor.fetchall()
             
             return [dict(row) for row in rows]
         except Exception as e:
@@ -400,23 +575,22 @@ class Database:
     def add_reminder(self, user_id: int, email: str, inbound_id: int, expire_time: int) -> bool:
         """Добавить напоминание о истечении конфига"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            # Удаляем старое напоминание если есть
-            cursor.execute("""
-                DELETE FROM reminders 
-                WHERE user_id = ? AND email = ? AND inbound_id = ?
-            """, (user_id, email, inbound_id))
+                # Удаляем старое напоминание если есть
+                cursor.execute("""
+                    DELETE FROM reminders 
+                    WHERE user_id = ? AND email = ? AND inbound_id = ?
+                """, (user_id, email, inbound_id))
             
-            # Добавляем новое
-            cursor.execute("""
-                INSERT INTO reminders (user_id, email, inbound_id, expire_time)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, email, inbound_id, expire_time))
+                # Добавляем новое
+                cursor.execute("""
+                    INSERT INTO reminders (user_id, email, inbound_id, expire_time)
+                    VALUES (?, ?, ?, ?)
+                """, (user_id, email, inbound_id, expire_time))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             return True
         except Exception as e:
             logger.error(f"Ошибка добавления напоминания: {e}")
@@ -424,49 +598,101 @@ class Database:
     
     def get_pending_reminders(self, days_before: int) -> List[Dict]:
         """Получить напоминания, которые нужно отправить"""
+        return [reminder for reminder, _ in self.get_pending_reminders_multi([days_before])]
+    
+    def get_pending_reminders_multi(self, days_list: List[int]) -> List[Tuple[Dict, int]]:
+        """Получить напоминания для всех порогов одним запросом
+        
+        Returns:
+            Список пар (напоминание, за сколько дней отправляется)
+        """
+        if not days_list:
+            return []
         try:
-            from datetime import datetime, timedelta
-            import time
-            
-            target_time = datetime.now() + timedelta(days=days_before)
-            target_timestamp = int(target_time.timestamp() * 1000)
-            
-            # Диапазон ±1 день для напоминаний
-            time_range = 24 * 60 * 60 * 1000  # 1 день в миллисекундах
-            
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            reminder_field = "reminder_10_days_sent" if days_before == 10 else "reminder_3_days_sent"
-            
-            cursor.execute(f"""
-                SELECT * FROM reminders 
-                WHERE expire_time >= ? AND expire_time <= ?
-                AND {reminder_field} = 0
-            """, (target_timestamp - time_range, target_timestamp + time_range))
-            
-            rows = cursor.fetchall()
-            conn.close()
+            day_ms = 24 * 60 * 60 * 1000  # 1 день в миллисекундах
+            now_ms = int(time.time() * 1000)
+            
+            # Один SELECT на порог, помеченный его числом дней, объединенные через UNION ALL.
+            # Окно по expire_time (±1 день) фильтруется индексом idx_reminders_pending_*
+            selects = []
+            params = []
+            for days_before in days_list:
+                target_timestamp = now_ms + days_before * day_ms
+                reminder_field = "reminder_10_days_sent" if days_before == 10 else "reminder_3_days_sent"
+                # Дату истечения для текста напоминания форматирует сама SQLite (в местном времени)
+                selects.append(f"""
+                    SELECT *, ? AS days_before,
+                        strftime('%Y-%m-%d %H:%M', expire_time / 1000, 'unixepoch', 'localtime') AS expire_date
+                    FROM reminders 
+                    WHERE {reminder_field} = 0
+                    AND expire_time BETWEEN ? AND ?
+                """)
+                params.extend((days_before, target_timestamp - day_ms, target_timestamp + day_ms))
+            
+            with self._acquire() as conn:
+                cursor = conn.cursor()
+                cursor.execute(" UNION ALL ".join(selects), params)
+                rows = cursor.fetchall()
             
-            return [dict(row) for row in rows]
+            result = []
+            for row in rows:
+                reminder = dict(row)
+                days_before = reminder.pop("days_before")
+                result.append((reminder, days_before))
+            return result
         except Exception as e:
             logger.error(f"Ошибка получения напоминаний: {e}")
             return []
     
+    def get_next_reminder_due(self, days_list: List[int]) -> Optional[int]:
+        """Когда (в миллисекундах) ближайшее неотправленное напоминание попадет в окно отправки
+        
+        Напоминание за N дней отправляется, когда до expire_time остается от N-1 до N+1 дней.
+        Учитываются только напоминания, окно которых еще не началось.
+        
+        Returns:
+            Время начала ближайшего окна или None, если таких напоминаний нет
+        """
+        if not days_list:
+            return None
+        try:
+            day_ms = 24 * 60 * 60 * 1000
+            now_ms = int(time.time() * 1000)
+            
+            selects = []
+            params = []
+            for days_before in days_list:
+                reminder_field = "reminder_10_days_sent" if days_before == 10 else "reminder_3_days_sent"
+                window_ms = (days_before + 1) * day_ms
+                selects.append(f"""
+                    SELECT MIN(expire_time) - ? FROM reminders 
+                    WHERE {reminder_field} = 0 AND expire_time > ?
+                """)
+                params.extend((window_ms, now_ms + window_ms))
+            
+            with self._acquire() as conn:
+                cursor = conn.cursor()
+                cursor.execute(" UNION ALL ".join(selects), params)
+                due_times = [row[0] for row in cursor.fetchall() if row[0] is not None]
+            
+            return min(due_times) if due_times else None
+        except Exception as e:
+            logger.error(f"Ошибка получения ближайшего напоминания: {e}")
+            return None
+    
     def mark_reminder_sent(self, reminder_id: int, days_before: int) -> bool:
         """Отметить напоминание как отправленное"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            reminder_field = "reminder_10_days_sent" if days_before == 10 else "reminder_3_days_sent"
+                reminder_field = "reminder_10_days_sent" if days_before == 10 else "reminder_3_days_sent"
             
-            cursor.execute(f"""
-                UPDATE reminders SET {reminder_field} = 1 WHERE id = ?
-            """, (reminder_id,))
+                cursor.execute(f"""
+                    UPDATE reminders SET {reminder_field} = 1 WHERE id = ?
+                """, (reminder_id,))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             return True
         except Exception as e:
             logger.error(f"Ошибка отметки напоминания: {e}")
@@ -474,7 +700,17 @@ class Database:
     
     def sync_reminders_from_xui(self, xui_client, user_id: int):
         """Синхронизировать напоминания из x-ui для пользователя"""
+        self.sync_reminders_bulk(xui_client, [user_id])
+    
+    def sync_reminders_bulk(self, xui_client, user_ids: List[int]) -> int:
+        """Синхронизировать напоминания из x-ui для нескольких пользователей одной транзакцией
+        
+        Returns:
+            int: количество обновленных напоминаний
+        """
         try:
+            # Собираем сроки действия всех клиентов x-ui: (email, inbound_id) -> expire_time
+            expire_times = {}
             inbounds = xui_client.get_inbounds()
             
             for inbound in inbounds:
@@ -482,26 +718,106 @@ class Database:
                 clients = xui_client.get_inbound_clients(inbound_id)
                 
                 for client in clients:
-                    email = client.get("email")
-                    expire_time = client.get("expireTime", 0)
-                    
+                    # В x-ui срок действия клиента хранится в поле expiryTime
+                    expire_time = client.get("expiryTime", 0)
                     if expire_time > 0:
-                        # Проверяем, есть ли этот конфиг в issued_configs для этого пользователя
-                        conn = self.get_connection()
-                        cursor = conn.cursor()
-                        
-                        cursor.execute("""
-                            SELECT * FROM issued_configs 
-                            WHERE user_id = ? AND email = ? AND inbound_id = ?
-                        """, (user_id, email, inbound_id))
-                        
-                        if cursor.fetchone():
-                            # Добавляем напоминание
-                            self.add_reminder(user_id, email, inbound_id, expire_time)
-                        
-                        conn.close()
+                        expire_times[(client.get("email"), inbound_id)] = expire_time
+            
+            if not expire_times or not user_ids:
+                return 0
+            
+            wanted = set(user_ids)
+            with self._acquire() as conn:
+                cursor = conn.cursor()
+                # Блокировку записи берем сразу, чтобы чтение выданных конфигов
+                # и замена напоминаний прошли одной транзакцией
+                cursor.execute("BEGIN IMMEDIATE")
+                
+                # Выданные конфиги всех пользователей одним запросом вместо запроса на каждого.
+                # Напоминания создаем только для конфигов, выданных этим пользователям
+                cursor.execute("SELECT DISTINCT user_id, email, inbound_id FROM issued_configs")
+                rows = []
+                for user_id, email, inbound_id in cursor.fetchall():
+                    if user_id not in wanted:
+                        continue
+                    expire_time = expire_times.get((email, inbound_id))
+                    if expire_time:
+                        rows.append((user_id, email, inbound_id, expire_time))
+                
+                # Удаляем старые напоминания и добавляем новые пачками
+                cursor.executemany("""
+                    DELETE FROM reminders 
+                    WHERE user_id = ? AND email = ? AND inbound_id = ?
+                """, [row[:3] for row in rows])
+                cursor.executemany("""
+                    INSERT INTO reminders (user_id, email, inbound_id, expire_time)
+                    VALUES (?, ?, ?, ?)
+                """, rows)
+                
+                # Один commit на всю синхронизацию вместо commit на каждое напоминание
+                conn.commit()
+            return len(rows)
         except Exception as e:
             logger.error(f"Ошибка синхронизации напоминаний: {e}")
+            return 0
+    
+    def clear_all_tables(self) -> List[str]:
+        """Очистить все таблицы базы данных
+        
+        Returns:
+            list: имена очищенных таблиц
+        """
+        with self._acquire() as conn:
+            cursor = conn.cursor()
+            
+            # Получаем список всех таблиц
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+            tables = cursor.fetchall()
+            
+            if not tables:
+                return []
+            
+            cleared_tables = [table[0] for table in tables]
+            # Имена таблиц подставляются в SQL, поэтому пропускаем только обычные идентификаторы
+            for table_name in cleared_tables:
+                if not TABLE_NAME_RE.match(table_name):
+                    raise ValueError(f"Недопустимое имя таблицы: {table_name!r}")
+            has_sequence = "sqlite_sequence" in cleared_tables
+            
+            # Соединение вернется в пул, поэтому после очистки восстанавливаем
+            # исходное значение проверки внешних ключей, а не включаем ее
+            cursor.execute("PRAGMA foreign_keys")
+            foreign_keys = int(cursor.fetchone()[0])
+            
+            # Очищаем все таблицы одним скриптом в одной транзакции.
+            # Проверку внешних ключей отключаем до BEGIN: внутри транзакции PRAGMA не действует
+            script = ["PRAGMA foreign_keys = OFF;", "BEGIN;"]
+            for table_name in cleared_tables:
+                script.append(f"DELETE FROM {table_name};")
+                if has_sequence:
+                    # Сбрасываем автоинкремент
+                    script.append(f"DELETE FROM sqlite_sequence WHERE name = '{table_name}';")
+            script.append("COMMIT;")
+            
+            try:
+                conn.executescript("\n".join(script))
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute(f"PRAGMA foreign_keys = {foreign_keys}")
+                # Кеши сбрасываем сразу после очистки, даже если она не удалась частично
+                self.invalidate_username_cache()
+                self._invalidate_users()
+            
+            # DELETE без WHERE при выключенных внешних ключах и без триггеров SQLite выполняет
+            # как truncate, но освободившиеся страницы остаются в файле - возвращаем их VACUUM.
+            # Таблицы к этому моменту уже очищены, поэтому ошибка VACUUM (например, база
+            # занята другим соединением) только логируется
+            try:
+                conn.execute("VACUUM")
+            except sqlite3.Error as e:
+                logger.warning(f"Не удалось выполнить VACUUM после очистки базы: {e}")
+        return cleared_tables
     
     def delete_user_data(self, username: str) -> Tuple[bool, str, Optional[int]]:
         """Удалить все данные пользователя по username
@@ -520,24 +836,25 @@ class Database:
             
             user_id = user['user_id']
             
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self._acquire() as conn:
+                cursor = conn.cursor()
             
-            # Подсчитываем количество записей перед удалением
-            cursor.execute("SELECT COUNT(*) FROM issued_configs WHERE user_id = ?", (user_id,))
-            configs_count = cursor.fetchone()[0]
+                # Подсчитываем количество записей перед удалением
+                cursor.execute("SELECT COUNT(*) FROM issued_configs WHERE user_id = ?", (user_id,))
+                configs_count = cursor.fetchone()[0]
             
-            cursor.execute("SELECT COUNT(*) FROM reminders WHERE user_id = ?", (user_id,))
-            reminders_count = cursor.fetchone()[0]
+                cursor.execute("SELECT COUNT(*) FROM reminders WHERE user_id = ?", (user_id,))
+                reminders_count = cursor.fetchone()[0]
             
-            # Удаляем данные из всех таблиц
-            cursor.execute("DELETE FROM alloved_users WHERE username = ?", (normalized_username,))
-            cursor.execute("DELETE FROM reminders WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM issued_configs WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                # Удаляем данные из всех таблиц
+                cursor.execute("DELETE FROM alloved_users WHERE username = ?", (normalized_username,))
+                cursor.execute("DELETE FROM reminders WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM issued_configs WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
+            self.invalidate_username_cache(normalized_username)
+            self._invalidate_users([user_id])
             
             message = (
                 f"✅ Данные пользователя @{normalized_username} (ID: {user_id}) успешно удалены:\n"
@@ -2,13 +2,63 @@
 Модуль для работы с x-ui API
 """
 import requests
+from requests.adapters import HTTPAdapter
+import base64
 import json
 import logging
-from typing import Optional, Dict, List, Any
+import random
+import string
+import threading
+import time
+import uuid as uuid_lib
+from urllib.parse import urlparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Any, Tuple
 from config import XUI_BASE_URL, XUI_USERNAME, XUI_PASSWORD
 
+# Импортируем новые переменные с дефолтными значениями для обратной совместимости
+try:
+    from config import XUI_CACHE_TTL
+except ImportError:
+    XUI_CACHE_TTL = 10  # Дефолтное значение: 10 секунд
+
+try:
+    from config import XUI_SESSION_TTL
+except ImportError:
+    XUI_SESSION_TTL = 600  # Дефолтное значение: 10 минут
+
 logger = logging.getLogger(__name__)
 
+# Размер пула keep-alive соединений к x-ui. Клиент вызывается из рабочих потоков
+# asyncio.to_thread (по умолчанию до 32 одновременно), а стандартный пул requests
+# держит только 10 соединений - лишние закрывались бы после каждого запроса
+XUI_POOL_SIZE = 32
+
+# Сколько запросов трафика по конфигам одного пользователя выполнять одновременно
+XUI_TRAFFIC_CONCURRENCY = 8
+
+
+class _InboundsSnapshot:
+    """Список inbounds, полученный от x-ui, и производные от него индексы
+    
+    Снимок привязан к одному списку: новый список получает новый снимок, который
+    подменяется одним присваиванием. Ленивые индексы строятся только из своего списка,
+    поэтому даже при одновременном заполнении из нескольких потоков в снимок
+    не попадут данные другого списка.
+    """
+    
+    def __init__(self, inbounds: List[Dict[str, Any]]):
+        self.inbounds = inbounds
+        self.fetched_at = time.monotonic()
+        # id -> inbound
+        self.by_id: Dict[int, Dict[str, Any]] = {inbound.get("id"): inbound for inbound in inbounds}
+        # email -> (inbound, client) по всем inbounds, строится при первом обращении
+        self.email_index: Optional[Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]]] = None
+        # inbound_id -> разобранный список клиентов и inbound_id -> {email: client}
+        self.clients: Dict[int, List[Dict[str, Any]]] = {}
+        self.clients_by_email: Dict[int, Dict[str, Dict[str, Any]]] = {}
+
 
 class XUIClient:
     """Клиент для работы с x-ui API"""
@@ -18,7 +68,26 @@ class XUIClient:
         self.username = XUI_USERNAME
         self.password = XUI_PASSWORD
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=XUI_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         self.token = None
+        # Время последней успешной авторизации (0 - не авторизованы)
+        self._logged_in_at = 0.0
+        self._login_lock = threading.Lock()
+        # Кеш списка inbounds вместе с индексами по нему
+        self._inbounds_snapshot: Optional[_InboundsSnapshot] = None
+        # Одновременные промахи кеша (из разных потоков) ждут один запрос к x-ui
+        self._inbounds_lock = threading.Lock()
+        # Потоки для параллельных запросов трафика (getClientTraffics) по нескольким email
+        self._traffic_executor = ThreadPoolExecutor(
+            max_workers=XUI_TRAFFIC_CONCURRENCY, thread_name_prefix="xui-traffic"
+        )
+        
+    def close(self):
+        """Закрыть HTTP-сессию и все открытые соединения к x-ui"""
+        self._traffic_executor.shutdown(wait=False)
+        self.session.close()
         
     def _login(self) -> bool:
         """Авторизация в x-ui панели"""
@@ -80,6 +149,7 @@ class XUIClient:
                                 # x-ui может использовать cookie-based аутентификацию
                                 logger.info("Токен не найден, используем cookie-based аутентификацию")
                             
+                            self._logged_in_at = time.monotonic()
                             return True
                         else:
                             logger.warning(f"Авторизация не удалась для {login_url}: {data.get('msg', 'Unknown error')}")
@@ -95,12 +165,57 @@ class XUIClient:
             logger.error(f"Ошибка авторизации: {e}", exc_info=True)
             return False
     
+    def _is_session_fresh(self) -> bool:
+        """Проверить, что авторизация получена не позднее XUI_SESSION_TTL секунд назад"""
+        return self._logged_in_at > 0 and time.monotonic() - self._logged_in_at < XUI_SESSION_TTL
+    
+    def _reset_session(self):
+        """Считать сессию недействительной: следующий запрос заново авторизуется"""
+        self._logged_in_at = 0.0
+    
     def _ensure_authenticated(self):
         """Проверка и обновление токена при необходимости"""
-        # Всегда переавторизуемся для надежности
-        # x-ui может использовать cookie-based аутентификацию, которая работает через сессию
-        if not self._login():
-            raise Exception("Не удалось авторизоваться в x-ui")
+        # x-ui использует cookie-based аутентификацию, которая хранится в сессии,
+        # поэтому повторно авторизуемся только когда сессия устарела или была сброшена
+        if self._is_session_fresh():
+            return
+        with self._login_lock:
+            # Пока ждали блокировку, другой поток мог уже авторизоваться
+            if self._is_session_fresh():
+                return
+            if not self._login():
+                raise Exception("Не удалось авторизоваться в x-ui")
+    
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Выполнить запрос к x-ui в текущей сессии
+        
+        Панель может завершить сессию раньше XUI_SESSION_TTL. Если ответ говорит,
+        что авторизации нет (401/403 или редирект на страницу входа),
+        авторизуемся заново и повторяем запрос один раз.
+        """
+        kwargs.setdefault("timeout", 10)
+        logged_in_at = self._logged_in_at
+        response = self.session.request(method, url, **kwargs)
+        if not self._is_auth_failure(response):
+            return response
+        
+        logger.info(f"Сессия x-ui недействительна (статус {response.status_code} для {url}), авторизуемся заново")
+        with self._login_lock:
+            # Если другой поток уже переавторизовался после нашего запроса, его сессию не сбрасываем
+            if self._logged_in_at == logged_in_at:
+                self._reset_session()
+        self._ensure_authenticated()
+        return self.session.request(method, url, **kwargs)
+    
+    @staticmethod
+    def _is_auth_failure(response: requests.Response) -> bool:
+        """Ответ x-ui означает, что сессия не авторизована"""
+        if response.status_code in (401, 403):
+            return True
+        # Неавторизованный запрос x-ui перенаправляет на страницу входа
+        if response.is_redirect:
+            return "login" in response.headers.get("Location", "").lower()
+        return bool(response.history) and urlparse(response.url).path.rstrip("/").endswith("/login")
 
     def getTrafficByEmail(self, email: str):
         '''Достать трафик клиента по email'''
@@ -130,7 +245,7 @@ class XUIClient:
                     "Content-Type": "application/json"
                 }
                 
-                response = self.session.get(url, headers=headers, timeout=10, allow_redirects=True)
+                response = self._request("GET", url, headers=headers, allow_redirects=True)
 
                 logger.info(f"Ответ получения getClientTraffics: статус {response.status_code}, Content-Type: {response.headers.get('Content-Type', 'unknown')}")
                 logger.info(f'response: {response.json()}')
@@ -145,14 +260,84 @@ class XUIClient:
 
             except Exception as e:
                 logger.error(f"Ошибка выполнения запроса получения трафика: {e}", exc_info=True)
+                # Вместо JSON могла прийти страница входа - сессия истекла
+                self._reset_session()
             return []
 
         except Exception as e:
             logger.error(f"Ошибка получения трафика: {e}", exc_info=True)
             return []
     
-    def get_inbounds(self) -> List[Dict[str, Any]]:
-        """Получить список всех inbounds"""
+    def invalidate_cache(self):
+        """Сбросить кеш списка inbounds"""
+        self._inbounds_snapshot = None
+    
+    def get_inbounds(self, use_cache: bool = True) -> List[Dict[str, Any]]:
+        """Получить список всех inbounds
+        
+        Args:
+            use_cache: Вернуть закешированный список, если он получен не позднее XUI_CACHE_TTL секунд назад.
+                Методы, которые изменяют inbound, должны запрашивать свежие данные (use_cache=False).
+        """
+        return self._get_snapshot(use_cache).inbounds
+    
+    def _get_snapshot(self, use_cache: bool = True) -> _InboundsSnapshot:
+        """Получить снимок списка inbounds (из кеша или свежий)"""
+        snapshot = self._inbounds_snapshot
+        if use_cache and self._is_snapshot_fresh(snapshot):
+            return snapshot
+        
+        with self._inbounds_lock:
+            # Пока ждали блокировку, список мог обновить другой поток
+            snapshot = self._inbounds_snapshot
+            if use_cache and self._is_snapshot_fresh(snapshot):
+                return snapshot
+            
+            snapshot = _InboundsSnapshot(self._fetch_inbounds())
+            # Пустой список не кешируем - это может быть ошибка авторизации или сети
+            if snapshot.inbounds:
+                self._inbounds_snapshot = snapshot
+            return snapshot
+    
+    @staticmethod
+    def _is_snapshot_fresh(snapshot: Optional[_InboundsSnapshot]) -> bool:
+        """Проверить, что закешированный список inbounds еще не устарел"""
+        return snapshot is not None and time.monotonic() - snapshot.fetched_at < XUI_CACHE_TTL
+    
+    def get_inbound(self, inbound_id: int, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """Получить inbound по ID из индекса id -> inbound снимка списка inbounds"""
+        return self._get_snapshot(use_cache).by_id.get(inbound_id)
+    
+    def get_email_index(self, use_cache: bool = True) -> Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Получить индекс клиентов всех inbounds: email -> (inbound, client)
+        
+        Индекс строится за один проход по списку inbounds, один раз на каждый
+        полученный от x-ui список.
+        """
+        snapshot = self._get_snapshot(use_cache)
+        email_index = snapshot.email_index
+        if email_index is not None:
+            return email_index
+        
+        email_index = {}
+        for inbound in snapshot.inbounds:
+            try:
+                settings_str = inbound.get("settings", "{}")
+                settings = json.loads(settings_str) if settings_str else {}
+            except json.JSONDecodeError as e:
+                logger.warning(f"Не удалось разобрать settings inbound {inbound.get('id')}: {e}")
+                continue
+            for client in settings.get("clients", []):
+                email = client.get("email")
+                # Как и при линейном поиске, выигрывает первый inbound с этим email
+                if email and email not in email_index:
+                    email_index[email] = (inbound, client)
+        
+        snapshot.email_index = email_index
+        return email_index
+    
+    def _fetch_inbounds(self) -> List[Dict[str, Any]]:
+        """Запросить список всех inbounds у x-ui"""
         try:
             self._ensure_authenticated()
         except Exception as e:
@@ -199,15 +384,15 @@ class XUIClient:
                     }
                     
                     if method == "GET":
-                        response = self.session.get(url, headers=headers, timeout=10, allow_redirects=True)
+                        response = self._request("GET", url, headers=headers, allow_redirects=True)
                     else:
                         # Пробуем POST с пустым телом и с пустым JSON объектом
                         # Некоторые версии x-ui требуют определенный формат
                         try:
-                            response = self.session.post(url, json={}, headers=headers, timeout=10, allow_redirects=True)
+                            response = self._request("POST", url, json={}, headers=headers, allow_redirects=True)
                         except:
                             # Если не сработало, пробуем без json
-                            response = self.session.post(url, data={}, headers=headers, timeout=10, allow_redirects=True)
+                            response = self._request("POST", url, data={}, headers=headers, allow_redirects=True)
                     
                     logger.info(f"Ответ получения inbounds: статус {response.status_code}, Content-Type: {response.headers.get('Content-Type', 'unknown')}")
                     
@@ -243,31 +428,14 @@ class XUIClient:
                     else:
                         # Если не 404, возможно это правильный URL, но с ошибкой
                         logger.warning(f"HTTP ошибка для {method} {url}: {response.status_code}, ответ: {response.text[:200]}")
-                        # Если получили ответ (не 404), возможно это правильный URL, но с ошибкой авторизации
-                        # Попробуем переавторизоваться и повторить запрос
-                        if response.status_code in [401, 403]:
-                            logger.info(f"Получен {response.status_code}, пробуем переавторизоваться...")
-                            if self._login():
-                                # Повторяем запрос после переавторизации
-                                if method == "GET":
-                                    retry_response = self.session.get(url, timeout=10)
-                                else:
-                                    retry_response = self.session.post(url, json={}, timeout=10)
-                                
-                                if retry_response.status_code == 200:
-                                    try:
-                                        retry_data = retry_response.json()
-                                        if retry_data.get("success"):
-                                            inbounds = retry_data.get("obj", [])
-                                            logger.info(f"✅ Успешно получено inbounds после переавторизации: {len(inbounds) if inbounds else 0}")
-                                            return inbounds if inbounds else []
-                                    except:
-                                        pass
+                        # Ошибки авторизации (401/403) уже обработал _request: переавторизовался и повторил запрос
                 except Exception as e:
                     logger.warning(f"Ошибка при запросе {method} {url}: {e}")
             
-            # Если все URL не сработали, возвращаем пустой список
+            # Если все URL не сработали, возвращаем пустой список.
+            # Возможно, сессия истекла на стороне x-ui - в следующий раз авторизуемся заново
             logger.error("Все варианты URL и методов не сработали")
+            self._reset_session()
             return []
         except Exception as e:
             logger.error(f"Ошибка получения inbounds: {e}", exc_info=True)
@@ -282,28 +450,70 @@ class XUIClient:
             return []
         
         try:
-            # Используем данные из списка inbounds - там уже есть вся информация
-            # Источники: https://github.com/MHSanaei/3x-ui
-            inbounds = self.get_inbounds()
-            inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
-            
-            if not inbound:
-                logger.error(f"Inbound {inbound_id} не найден в списке")
-                return []
-            
-            # Парсим settings
-            settings_str = inbound.get("settings", "{}")
-            settings = json.loads(settings_str) if settings_str else {}
-            
-            # Получаем клиентов из settings
-            clients = settings.get("clients", [])
-            
-            logger.info(f"Получено клиентов для inbound {inbound_id}: {len(clients) if clients else 0}")
-            return clients if clients else []
+            return self._snapshot_clients(self._get_snapshot(), inbound_id)
         except Exception as e:
             logger.error(f"Ошибка получения клиентов: {e}", exc_info=True)
             return []
     
+    def _snapshot_clients(self, snapshot: _InboundsSnapshot, inbound_id: int) -> List[Dict[str, Any]]:
+        """Клиенты inbound из снимка: settings разбираются один раз на снимок"""
+        clients = snapshot.clients.get(inbound_id)
+        if clients is not None:
+            return clients
+        
+        # Используем данные из списка inbounds - там уже есть вся информация
+        # Источники: https://github.com/MHSanaei/3x-ui
+        inbound = snapshot.by_id.get(inbound_id)
+        if not inbound:
+            logger.error(f"Inbound {inbound_id} не найден в списке")
+            return []
+        
+        # Парсим settings и получаем клиентов
+        settings_str = inbound.get("settings", "{}")
+        settings = json.loads(settings_str) if settings_str else {}
+        clients = settings.get("clients", []) or []
+        
+        logger.info(f"Получено клиентов для inbound {inbound_id}: {len(clients)}")
+        snapshot.clients[inbound_id] = clients
+        return clients
+    
+    def _snapshot_clients_by_email(self, snapshot: _InboundsSnapshot,
+                                   inbound_id: int) -> Dict[str, Dict[str, Any]]:
+        """Клиенты inbound из снимка в виде словаря email -> client"""
+        by_email = snapshot.clients_by_email.get(inbound_id)
+        if by_email is None:
+            by_email = {c.get("email"): c for c in self._snapshot_clients(snapshot, inbound_id)}
+            snapshot.clients_by_email[inbound_id] = by_email
+        return by_email
+    
+    def get_inbound_clients_by_email(self, inbound_id: int) -> Dict[str, Dict[str, Any]]:
+        """Получить клиентов inbound в виде словаря email -> client
+        
+        Словарь строится один раз на каждый полученный от x-ui список inbounds,
+        поэтому поиск клиента по email не перебирает весь список клиентов.
+        """
+        try:
+            return self._snapshot_clients_by_email(self._get_snapshot(), inbound_id)
+        except Exception as e:
+            logger.error(f"Ошибка получения клиентов: {e}", exc_info=True)
+            return {}
+    
+    def get_client_by_email(self, email: str, inbound_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Найти клиента по email
+        
+        Берется из индекса email -> (inbound, client) вместо разбора всего списка клиентов inbound.
+        Если указан inbound_id, а в индексе клиент с этим email из другого inbound,
+        ищем среди клиентов нужного inbound.
+        """
+        entry = self.get_email_index().get(email)
+        if entry:
+            inbound, client = entry
+            if inbound_id is None or inbound.get("id") == inbound_id:
+                return client
+        if inbound_id is None:
+            return None
+        return self.get_inbound_clients_by_email(inbound_id).get(email)
+    
     def get_client_config(self, inbound_id: int, email: str, protocol: str = "vless") -> Optional[str]:
         """Получить конфигурацию клиента для подключения"""
         self._ensure_authenticated()
@@ -311,28 +521,33 @@ class XUIClient:
         try:
             # Используем данные из списка inbounds - там уже есть вся информация
             # Источники: https://github.com/MHSanaei/3x-ui
-            inbounds = self.get_inbounds()
-            inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
+            # inbound и клиента берем из одного снимка списка inbounds
+            snapshot = self._get_snapshot()
+            inbound = snapshot.by_id.get(inbound_id)
             
             if not inbound:
                 logger.error(f"Inbound {inbound_id} не найден в списке")
                 return None
             
-            # Парсим settings и streamSettings
-            settings_str = inbound.get("settings", "{}")
-            settings = json.loads(settings_str) if settings_str else {}
-            
-            stream_settings_str = inbound.get("streamSettings", "{}")
-            stream_settings = json.loads(stream_settings_str) if stream_settings_str else {}
-            
-            # Получаем клиента
-            clients = settings.get("clients", [])
-            client = next((c for c in clients if c.get("email") == email), None)
+            # Получаем клиента из уже разобранного словаря email -> client
+            client = self._snapshot_clients_by_email(snapshot, inbound_id).get(email)
             
             if not client:
                 logger.warning(f"Клиент с email {email} не найден в inbound {inbound_id}")
                 return None
             
+            return self.build_client_config(inbound, client, protocol)
+        except Exception as e:
+            logger.error(f"Ошибка получения конфигурации: {e}", exc_info=True)
+            return None
+    
+    def build_client_config(self, inbound: Dict[str, Any], client: Dict[str, Any],
+                            protocol: str = "vless") -> Optional[str]:
+        """Сформировать конфигурацию клиента по уже известным inbound и клиенту, без запросов к x-ui"""
+        try:
+            stream_settings_str = inbound.get("streamSettings", "{}")
+            stream_settings = json.loads(stream_settings_str) if stream_settings_str else {}
+            
             # Формируем конфигурацию в зависимости от протокола
             if protocol.lower() == "vless":
                 return self._generate_vless_config(
@@ -358,7 +573,7 @@ class XUIClient:
             
             return None
         except Exception as e:
-            logger.error(f"Ошибка получения конфигурации: {e}", exc_info=True)
+            logger.error(f"Ошибка формирования конфигурации: {e}", exc_info=True)
             return None
     
     def _generate_vless_config(self, uuid: str, port: int, remark: str, stream_settings: dict) -> str:
@@ -426,8 +641,6 @@ class XUIClient:
     
     def _generate_vmess_config(self, uuid: str, port: int, remark: str, stream_settings: dict) -> str:
         """Генерация VMESS конфигурации"""
-        import base64
-        
         network = stream_settings.get("network", "tcp")
         security = stream_settings.get("security", "none")
         host = stream_settings.get("wsSettings", {}).get("headers", {}).get("Host", "")
@@ -471,8 +684,14 @@ class XUIClient:
         
         return config
     
-    def get_user_configs(self, inbound_id: int, base_username: str) -> List[Dict[str, Any]]:
-        """Получить список всех конфигов пользователя (username, username_1, username_2, ...)"""
+    def get_user_configs(self, inbound_id: int, base_username: str,
+                         with_traffic: bool = True) -> List[Dict[str, Any]]:
+        """Получить список всех конфигов пользователя (username, username_1, username_2, ...)
+        
+        Args:
+            with_traffic: Запросить трафик каждого конфига (отдельный HTTP-запрос на конфиг).
+                Если трафик не нужен, список строится только по закешированным клиентам inbound.
+        """
         try:
             self._ensure_authenticated()
         except Exception as e:
@@ -480,55 +699,43 @@ class XUIClient:
             return []
         
         try:
-            # Получаем список inbounds
-            inbounds = self.get_inbounds()
-            inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
-            
-            if not inbound:
-                logger.warning(f"Inbound {inbound_id} не найден")
-                return []
-            
-            # Парсим settings
-            settings_str = inbound.get("settings", "{}")
-            settings = json.loads(settings_str) if settings_str else {}
-            
-            # Получаем существующих клиентов
-            clients = settings.get("clients", [])
+            # Получаем существующих клиентов (settings уже разобраны в кеше)
+            clients = self.get_inbound_clients(inbound_id)
             
             # Находим все конфиги пользователя
             user_configs = []
+            prefix = f"{base_username}_"
             for client in clients:
                 client_email = client.get("email", "")
                 if client_email == base_username:
                     # Базовый email без номера
-
-                    user_traffic = self.getTrafficByEmail(client_email)
-
-                    user_configs.append({
-                        "email": client_email,
-                        "number": 0,
-                        "client": client,
-                        "traffic": user_traffic
-                    })
-
-                elif client_email.startswith(f"{base_username}_"):
+                    number = 0
+                elif client_email.startswith(prefix):
                     # Email с номером (username_N)
-                    suffix = client_email[len(f"{base_username}_"):]
                     try:
-                        number = int(suffix)
-
-                        user_traffic = self.getTrafficByEmail(client_email)
-
-                        user_configs.append({
-                            "email": client_email,
-                            "number": number,
-                            "client": client,
-                            "traffic": user_traffic
-                        })
-
+                        number = int(client_email[len(prefix):])
                     except ValueError:
                         # Если не число, игнорируем
-                        pass
+                        continue
+                else:
+                    continue
+                
+                user_configs.append({
+                    "email": client_email,
+                    "number": number,
+                    "client": client,
+                })
+            
+            # Трафик запрашивается отдельным HTTP-запросом на каждый конфиг,
+            # поэтому запросы для нескольких конфигов выполняются параллельно
+            if with_traffic:
+                emails = [config["email"] for config in user_configs]
+                if len(emails) > 1:
+                    traffics = list(self._traffic_executor.map(self.getTrafficByEmail, emails))
+                else:
+                    traffics = [self.getTrafficByEmail(email) for email in emails]
+                for config, traffic in zip(user_configs, traffics):
+                    config["traffic"] = traffic
 
             # Сортируем по номеру
             user_configs.sort(key=lambda x: x["number"])
@@ -568,7 +775,7 @@ class XUIClient:
                 pass  # Не очищаем cookies, так как нужна авторизация
             
             # Получаем список inbounds (всегда свежий запрос)
-            inbounds = self.get_inbounds()
+            inbounds = self.get_inbounds(use_cache=False)
             inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
             
             if not inbound:
@@ -700,24 +907,18 @@ class XUIClient:
         try:
             # Используем данные из списка inbounds - там уже есть вся информация
             # Источники: https://github.com/MHSanaei/3x-ui
-            inbounds = self.get_inbounds()
-            
             if inbound_id is None:
-                # Ищем во всех inbounds
-                for inbound in inbounds:
-                    settings_str = inbound.get("settings", "{}")
-                    settings = json.loads(settings_str) if settings_str else {}
-                    clients = settings.get("clients", [])
-                    if any(c.get("email") == email for c in clients):
-                        inbound_id = inbound.get("id")
-                        break
-                
-                if inbound_id is None:
+                # Ищем во всех inbounds через индекс email -> (inbound, client)
+                entry = self.get_email_index().get(email)
+                if not entry:
                     logger.warning(f"Клиент с email {email} не найден ни в одном inbound")
                     return None
+                inbound = entry[0]
+                inbound_id = inbound.get("id")
+            else:
+                # Находим inbound по ID
+                inbound = self.get_inbound(inbound_id)
             
-            # Находим inbound по ID
-            inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
             if not inbound:
                 logger.error(f"Inbound {inbound_id} не найден в списке")
                 return None
@@ -746,7 +947,8 @@ class XUIClient:
             # Получаем список inbounds - там уже есть вся информация
             # Источники: https://github.com/MHSanaei/3x-ui
             # Postman коллекция: https://www.postman.com/hsanaei/3x-ui/collection/q1l5l0u/3x-ui
-            inbounds = self.get_inbounds()
+            # Нужны свежие данные: при fallback через update inbound перезаписывается список клиентов
+            inbounds = self.get_inbounds(use_cache=False)
             inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
             
             if not inbound:
@@ -766,13 +968,10 @@ class XUIClient:
                 return False  # Клиент уже существует
             
             # Генерируем UUID если не указан
-            import uuid as uuid_lib
             if not uuid:
                 uuid = str(uuid_lib.uuid4())
             
             # Генерируем subId
-            import random
-            import string
             sub_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=16))
             
             # Создаем нового клиента согласно документации 3x-ui
@@ -813,14 +1012,14 @@ class XUIClient:
             for test_url in add_client_urls:
                 logger.info(f"Попытка добавления клиента через {test_url}")
                 try:
-                    test_response = self.session.post(
+                    test_response = self._request(
+                        "POST",
                         test_url,
                         json=add_client_data,
                         headers={
                             "Accept": "application/json",
                             "Content-Type": "application/json"
-                        },
-                        timeout=10
+                        }
                     )
                     logger.info(f"Ответ добавления клиента: статус {test_response.status_code}")
                     
@@ -829,6 +1028,7 @@ class XUIClient:
                             result = test_response.json()
                             if result.get("success"):
                                 logger.info(f"✅ Клиент {email} успешно добавлен к inbound {inbound_id} через {test_url}")
+                                self.invalidate_cache()
                                 return True
                             else:
                                 logger.warning(f"API вернул success=False для {test_url}: {result.get('msg', 'Unknown error')}")
@@ -870,14 +1070,14 @@ class XUIClient:
             for test_url in update_urls_to_try:
                 logger.info(f"Попытка обновления inbound {inbound_id}: {test_url}")
                 try:
-                    test_response = self.session.post(
+                    test_response = self._request(
+                        "POST",
                         test_url,
                         json=update_data,
                         headers={
                             "Accept": "application/json",
                             "Content-Type": "application/json"
-                        },
-                        timeout=10
+                        }
                     )
                     logger.info(f"Ответ обновления inbound: статус {test_response.status_code}")
                     
@@ -887,6 +1087,7 @@ class XUIClient:
                             success = update_result.get("success", False)
                             if success:
                                 logger.info(f"✅ Клиент {email} успешно добавлен к inbound {inbound_id} через update")
+                                self.invalidate_cache()
                                 return True
                             else:
                                 logger.warning(f"API вернул success=False для {test_url}: {update_result.get('msg', 'Unknown error')}")
@@ -898,29 +1099,34 @@ class XUIClient:
                     logger.warning(f"Ошибка при запросе {test_url}: {e}")
             
             logger.error("Все варианты URL для добавления клиента не сработали")
+            self._reset_session()
             return False
         except Exception as e:
             logger.error(f"Ошибка добавления клиента: {e}", exc_info=True)
             return False
     
-    def update_client_expiry(self, inbound_id: int, email: str, add_days: int = 31) -> bool:
-        """Обновить срок действия клиента (продлить на указанное количество дней)"""
+    def update_client_expiry(self, inbound_id: int, email: str, add_days: int = 31) -> Optional[int]:
+        """Обновить срок действия клиента (продлить на указанное количество дней)
+        
+        Returns:
+            Новый срок действия в миллисекундах или None, если продлить не удалось
+        """
         try:
             self._ensure_authenticated()
         except Exception as e:
             logger.error(f"Ошибка авторизации: {e}")
-            return False
+            return None
         
         try:
             logger.info(f"Продление конфига для {email} на {add_days} дней в inbound {inbound_id}")
             
-            # Получаем список inbounds
-            inbounds = self.get_inbounds()
+            # Получаем свежий список inbounds: settings будут перезаписаны целиком
+            inbounds = self.get_inbounds(use_cache=False)
             inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
             
             if not inbound:
                 logger.error(f"Inbound {inbound_id} не найден в списке")
-                return False
+                return None
             
             # Парсим settings
             settings_str = inbound.get("settings", "{}")
@@ -934,10 +1140,9 @@ class XUIClient:
             
             if not client:
                 logger.error(f"Клиент с email {email} не найден в inbound {inbound_id}")
-                return False
+                return None
             
             # Вычисляем новый срок действия
-            import time
             current_time = int(time.time() * 1000)  # Текущее время в миллисекундах
             current_expiry = client.get("expiryTime", 0)
             
@@ -948,7 +1153,7 @@ class XUIClient:
                 # Продлеваем существующий срок
                 new_expiry = current_expiry + (add_days * 24 * 60 * 60 * 1000)
             
-            # Обновляем expireTime клиента
+            # Обновляем expiryTime клиента
             client["expiryTime"] = new_expiry
             
             # Обновляем settings
@@ -990,14 +1195,14 @@ class XUIClient:
             for test_url in update_urls_to_try:
                 logger.info(f"Попытка обновления клиента через {test_url}")
                 try:
-                    test_response = self.session.post(
+                    test_response = self._request(
+                        "POST",
                         test_url,
                         json=update_data,
                         headers={
                             "Accept": "application/json",
                             "Content-Type": "application/json"
-                        },
-                        timeout=10
+                        }
                     )
                     logger.info(f"Ответ обновления клиента: статус {test_response.status_code}")
                     
@@ -1005,10 +1210,10 @@ class XUIClient:
                         try:
                             result = test_response.json()
                             if result.get("success"):
-                                from datetime import datetime
                                 new_expiry_date = datetime.fromtimestamp(new_expiry / 1000)
                                 logger.info(f"✅ Срок действия конфига для {email} продлен до {new_expiry_date.strftime('%Y-%m-%d %H:%M')}")
-                                return True
+                                self.invalidate_cache()
+                                return new_expiry
                             else:
                                 logger.warning(f"API вернул success=False для {test_url}: {result.get('msg', 'Unknown error')}")
                         except json.JSONDecodeError as e:
@@ -1019,8 +1224,9 @@ class XUIClient:
                     logger.warning(f"Ошибка при запросе {test_url}: {e}")
             
             logger.error("Все варианты URL для обновления клиента не сработали")
-            return False
+            self._reset_session()
+            return None
         except Exception as e:
             logger.error(f"Ошибка обновления срока действия клиента: {e}", exc_info=True)
-            return False
+            return None
 